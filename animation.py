@@ -0,0 +1,48 @@
+import collections
+import math
+
+import numpy as np
+
+Keyframe = collections.namedtuple('Keyframe', ['position', 'look_at', 'fov'],
+                                  defaults=[None])
+Keyframe.__doc__ = """
+Camera state of one animation frame. `fov` None keeps the renderer's fov.
+"""
+
+
+def interpolate(keyframes, steps):
+    """
+    Insert `steps - 1` linearly interpolated frames between consecutive
+    keyframes.
+    """
+    frames = []
+    for a, b in zip(keyframes, keyframes[1:]):
+        for i in range(steps):
+            s = i / steps
+            fov = a.fov
+            if a.fov is not None and b.fov is not None:
+                fov = (1 - s) * a.fov + s * b.fov
+            frames.append(
+                Keyframe((1 - s) * np.array(a.position) +
+                         s * np.array(b.position),
+                         (1 - s) * np.array(a.look_at) +
+                         s * np.array(b.look_at), fov))
+    return frames + list(keyframes[-1:])
+
+
+def turntable(num_frames,
+              center=(0.0, 0.0, 0.0),
+              radius=2.04,
+              height=0.5,
+              fov=None):
+    """
+    Keyframes of one full orbit around `center`. The defaults match the
+    initial camera of a Scene.
+    """
+    frames = []
+    for i in range(num_frames):
+        angle = 2 * math.pi * i / num_frames
+        position = (center[0] + radius * math.sin(angle), center[1] + height,
+                    center[2] + radius * math.cos(angle))
+        frames.append(Keyframe(position, center, fov))
+    return frames
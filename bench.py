@@ -0,0 +1,187 @@
+import argparse
+import ast
+import glob
+import json
+import multiprocessing
+import resource
+import runpy
+import sys
+import time
+
+import taichi as ti
+
+from scene import scene_overrides
+
+# Camera positions for --orientations, all looking at the grid center. The
+# axis views send rays along one memory stride of the voxel grid each (the
+# top view is tilted slightly, as the camera cannot look straight down).
+ORIENTATIONS = {
+    'x': (2.5, 0.2, 0.0),
+    'y': (0.0, 2.5, 0.2),
+    'z': (0.0, 0.2, 2.5),
+    'diagonal': (1.5, 1.5, 1.5),
+}
+
+
+def timed(func, repeat=1):
+    # Seconds per call, with asynchronous kernel launches included
+    ti.sync()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    ti.sync()
+    return (time.perf_counter() - t) / repeat
+
+
+def measure_orientations(renderer, renders):
+    # Mrays/s with the camera looking along each axis; compare one
+    # orientation across voxel orders, as the scene content differs per view
+    result = {}
+    width, height = renderer.image_res
+    for name, position in ORIENTATIONS.items():
+        renderer.set_camera_pos(*position)
+        renderer.set_look_at(0.0, 0.0, 0.0)
+        renderer.reset_framebuffer()
+        per_frame = timed(renderer.accumulate, renders)
+        result[name] = width * height / per_frame / 1e6
+    return result
+
+
+def measure_scene(scene, renders, orientations=False):
+    renderer = scene.renderer
+    result = {'voxel_init_s': scene.timings['voxels']}
+
+    # First calls include JIT compilation
+    first_bbox = timed(renderer.recompute_bbox)
+    result['recompute_bbox_s'] = timed(renderer.recompute_bbox)
+    renderer.reset_framebuffer()
+    first_render = timed(renderer.accumulate)
+    per_frame = timed(renderer.accumulate, renders)
+    result['render_s_per_frame'] = per_frame
+    result['compile_s'] = (first_bbox - result['recompute_bbox_s'] +
+                           first_render - per_frame)
+
+    width, height = renderer.image_res
+    result['mrays_per_sec'] = width * height / per_frame / 1e6
+    result['spp_per_sec'] = 1 / per_frame
+
+    # The first bounce's shadow rays on their own, to see their share of
+    # render time
+    buffers = renderer.shadow_ray_buffers()
+    num_shadow_rays = renderer.trace_shadow_rays(*buffers)
+    result['shadow_s_per_frame'] = timed(
+        lambda: renderer.trace_shadow_rays(*buffers), renders)
+    result['shadow_mrays_per_sec'] = (num_shadow_rays /
+                                      result['shadow_s_per_frame'] / 1e6)
+    result['device_memory_bytes'] = sum(renderer.memory_usage().values())
+    # ru_maxrss is in KiB on Linux; the peak is process-wide, which is why
+    # every scene runs in its own process
+    result['peak_host_memory_bytes'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * 1024
+    if orientations:
+        result['orientation_mrays_per_sec'] = measure_orientations(
+            renderer, renders)
+    return result
+
+
+def run_scene(script, renders, orientations=False, **options):
+    result = {}
+
+    def on_finish(scene):
+        result.update(measure_scene(scene, renders, orientations))
+
+    with scene_overrides(headless=True, on_finish=on_finish, **options):
+        runpy.run_path(script, run_name='__main__')
+    return result
+
+
+def parse_option(text):
+    key, value = text.split('=', 1)
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    for script, result in report['scenes'].items():
+        old = baseline['scenes'].get(script)
+        if old and result['mrays_per_sec'] < old['mrays_per_sec'] * (
+                1 - tolerance):
+            regressions.append(
+                f"{script}: {result['mrays_per_sec']:.3f} Mrays/s, "
+                f"baseline {old['mrays_per_sec']:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark voxel generation, recompute_bbox and '
+        'rendering of the example scenes without opening a window.')
+    parser.add_argument('scripts', nargs='*',
+                        help='scene scripts (default: example*.py)')
+    parser.add_argument('--renders', type=int, default=8,
+                        help='timed render calls per scene')
+    parser.add_argument('--arch', default='cpu')
+    parser.add_argument('--res', type=int, nargs=2, default=(640, 360),
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='extra Scene option, e.g. voxel_layout=sparse')
+    parser.add_argument('--orientations', action='store_true',
+                        help='also measure Mrays/s with the camera looking '
+                        'along each grid axis, e.g. to compare voxel_order '
+                        'options')
+    parser.add_argument('-o', '--output', help='write the JSON report here')
+    parser.add_argument('--baseline',
+                        help='JSON report to compare Mrays/s against; exits '
+                        'with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative slowdown vs. the baseline')
+    args = parser.parse_args()
+
+    scripts = args.scripts or sorted(glob.glob('example*.py'))
+    options = dict(parse_option(text) for text in args.option)
+    report = {
+        'arch': args.arch,
+        'res': list(args.res),
+        'renders': args.renders,
+        'options': options,
+        'scenes': {},
+    }
+    # A fresh process per scene keeps peak memory and compiled kernels of
+    # one scene out of the next one's numbers
+    context = multiprocessing.get_context('spawn')
+    for script in scripts:
+        with context.Pool(1) as pool:
+            result = pool.apply(
+                run_scene, (script, args.renders, args.orientations),
+                dict(arch=getattr(ti, args.arch),
+                     image_res=tuple(args.res),
+                     **options))
+        report['scenes'][script] = result
+        print(f"{script}: {result['mrays_per_sec']:.3f} Mrays/s, "
+              f"compile {result['compile_s']:.2f}s",
+              file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
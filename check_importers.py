@@ -0,0 +1,89 @@
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+import taichi as ti
+
+from importers import load_vox
+from renderer import OCCUPANCY_BRICK_SIZES, Renderer
+from scene import MAT_LAMBERTIAN
+
+
+def _chunk(chunk_id, content, children=b''):
+    return struct.pack('<4sii', chunk_id, len(content),
+                       len(children)) + content + children
+
+
+def write_vox(path, size, voxels, rgba):
+    """
+    Write a minimal MagicaVoxel file with one model of `size`, `voxels` as
+    (x, y, z, color index) rows and a 256 x 4 `rgba` palette chunk.
+    """
+    voxels = np.asarray(voxels, dtype=np.uint8)
+    children = (_chunk(b'SIZE', struct.pack('<3i', *size)) +
+                _chunk(b'XYZI',
+                       struct.pack('<i', len(voxels)) + voxels.tobytes()) +
+                _chunk(b'RGBA', np.asarray(rgba, dtype=np.uint8).tobytes()))
+    with open(path, 'wb') as f:
+        f.write(b'VOX ' + struct.pack('<i', 150))
+        f.write(_chunk(b'MAIN', b'', children))
+
+
+def check(seed=0):
+    """
+    Load a .vox file with a random RGBA palette and compare the colors and
+    materials of the imported voxels with the palette. Returns a list of
+    mismatches.
+    """
+    ti.init(arch=ti.cpu, random_seed=seed)
+    renderer = Renderer(dx=2 / 64,
+                        image_res=(8, 8),
+                        up=(0, 1, 0),
+                        voxel_edges=0.06,
+                        grid_res=64)
+    rng = np.random.default_rng(seed)
+    rgba = rng.integers(0, 256, size=(256, 4), dtype=np.uint8)
+    size = (16, 16, 16)
+    xyz = np.unique(rng.integers(0, 16, size=(64, 3)), axis=0)
+    indices = rng.integers(1, 256, size=len(xyz))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'palette.vox')
+        write_vox(path, size, np.column_stack([xyz, indices]), rgba)
+        load_vox(renderer, path, offset=(0, 0, 0))
+
+    bricks, materials, colors = renderer.export_bricks()
+    brick_size = OCCUPANCY_BRICK_SIZES[0]
+    lookup = {tuple(b): n for n, b in enumerate(bricks.tolist())}
+    errors = []
+    for (x, y, z), index in zip(xyz.tolist(), indices.tolist()):
+        # .vox is z up, the renderer y up
+        ijk = np.array([x, z, -y])
+        brick = lookup.get(tuple(np.floor_divide(ijk, brick_size)))
+        if brick is None:
+            errors.append(f'voxel {ijk.tolist()} is missing')
+            continue
+        i, j, k = np.mod(ijk, brick_size)
+        expected = rgba[index - 1, :3]
+        if materials[brick, i, j, k] != MAT_LAMBERTIAN:
+            errors.append(f'voxel {ijk.tolist()} has material '
+                          f'{materials[brick, i, j, k]}')
+        if (colors[brick, i, j, k] != expected).any():
+            errors.append(f'voxel {ijk.tolist()} has color '
+                          f'{colors[brick, i, j, k].tolist()}, palette '
+                          f'entry {index} is {expected.tolist()}')
+    return errors
+
+
+def main():
+    errors = check()
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    print('Imported .vox colors match the RGBA palette')
+
+
+if __name__ == '__main__':
+    main()
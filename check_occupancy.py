@@ -0,0 +1,75 @@
+import argparse
+import sys
+
+import numpy as np
+import taichi as ti
+
+from renderer import OCCUPANCY_BRICK_SIZES, Renderer
+
+
+def check(grid_res, seed=0):
+    """
+    Fill a grid with random voxels, clear some of them through the
+    incremental path (set_voxel + flush_voxel_edits) and compare the
+    occupancy pyramid and bbox with a rebuild from scratch. Returns a list
+    of mismatches.
+    """
+    ti.init(arch=ti.cpu, random_seed=seed)
+    renderer = Renderer(dx=2 / grid_res,
+                        image_res=(8, 8),
+                        up=(0, 1, 0),
+                        voxel_edges=0.06,
+                        grid_res=grid_res)
+    rng = np.random.default_rng(seed)
+    half = grid_res // 2
+    # Small clusters spread over the grid, so that bricks of every level
+    # are occupied, cleared and kept
+    centers = rng.integers(-half + 4, half - 4, size=(32, 3))
+    coords = (centers[:, None, :] +
+              rng.integers(-3, 4, size=(32, 16, 3))).reshape(-1, 3)
+    materials = np.ones(len(coords), dtype=np.int8)
+    colors = np.full((len(coords), 3), 255, dtype=np.uint8)
+    renderer.set_voxels_from_numpy(materials, colors, coords=coords)
+    renderer.flush_voxel_edits()
+    cleared = coords[rng.random(len(coords)) < 0.5]
+    renderer.set_voxels_from_numpy(np.zeros(len(cleared), dtype=np.int8),
+                                   np.zeros((len(cleared), 3), np.uint8),
+                                   coords=cleared)
+    renderer.flush_voxel_edits()
+    incremental = [o.to_numpy() for o in renderer.occupancy]
+    bbox = renderer.bbox.to_numpy()
+
+    renderer.recompute_occupancy()
+    renderer.recompute_bbox()
+    errors = []
+    for size, inc, o in zip(OCCUPANCY_BRICK_SIZES, incremental,
+                            renderer.occupancy):
+        mismatches = int((inc != o.to_numpy()).sum())
+        if mismatches:
+            errors.append(f'grid_res={grid_res}: {mismatches} {size}^3 '
+                          f'bricks differ from a full rebuild')
+    if not np.allclose(bbox, renderer.bbox.to_numpy()):
+        errors.append(f'grid_res={grid_res}: bbox {bbox.tolist()} differs '
+                      f'from {renderer.bbox.to_numpy().tolist()}')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that incremental voxel edits keep the occupancy '
+        'pyramid and bbox identical to a rebuild from scratch.')
+    parser.add_argument('--grid-res', type=int, nargs='*',
+                        default=[32, 64, 96, 128, 160])
+    args = parser.parse_args()
+    errors = []
+    for grid_res in args.grid_res:
+        errors += check(grid_res)
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    print(f'Occupancy consistent for grid_res {args.grid_res}')
+
+
+if __name__ == '__main__':
+    main()
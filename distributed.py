@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import runpy
+import tempfile
+import time
+
+import taichi as ti
+
+from scene import scene_overrides
+
+
+def _render_share(scene, part, workers, spp, split):
+    # Render this process' part of the image: a share of the samples of
+    # every pixel, or all samples of an interleaved subset of the tiles.
+    # Returns the per-pixel sums and the seconds spent rendering.
+    t = time.perf_counter()
+    if split == 'tiles':
+        scheduler = scene.scheduler
+        scene.renderer.flush_voxel_edits()
+        scene.renderer.reset_framebuffer()
+        scheduler.render_tiles(scheduler.split(workers)[part], spp)
+    else:
+        scene.accumulate(spp)
+    accumulation = scene.renderer.get_accumulation()
+    return accumulation, time.perf_counter() - t
+
+
+def _render_partial(script, part, workers, spp, split, voxels, options):
+    result = {}
+
+    def on_finish(scene):
+        # Scripts may generate voxels with ti.random(), which depends on the
+        # seed, so render the coordinator's voxels instead of our own
+        scene.load(voxels)
+        result['accumulation'] = _render_share(scene, part, workers, spp,
+                                               split)
+
+    with scene_overrides(headless=True,
+                         seed=part,
+                         on_finish=on_finish,
+                         **options):
+        runpy.run_path(script, run_name='__main__')
+    return result['accumulation']
+
+
+def render_distributed(script,
+                       workers,
+                       spp,
+                       output,
+                       split='samples',
+                       **options):
+    """
+    Render `script` with `spp` samples per pixel split across `workers`
+    processes, each running its own Renderer with a distinct seed. With
+    `split='samples'` every process renders a share of the samples of all
+    pixels; with `split='tiles'` every process renders all samples of an
+    interleaved subset of the scheduler's tiles. The calling process renders
+    its part as well, then adds up the per-pixel sums of all workers, which
+    are zero outside a worker's tiles, and writes one tonemapped image to
+    `output`. The workers render the voxels generated by the calling
+    process. `options` are forwarded to every Scene; on the CPU backend
+    each process uses 1/`workers` of the cores unless `cpu_max_num_threads`
+    is given.
+    """
+    if options.get('arch', ti.cpu) == ti.cpu:
+        # Each process would otherwise start one thread per core
+        options.setdefault('cpu_max_num_threads',
+                           max(1, (os.cpu_count() or 1) // workers))
+    if split == 'tiles':
+        shares = [spp] * workers
+    elif split == 'samples':
+        shares = [spp // workers + (i < spp % workers) for i in range(workers)]
+    else:
+        raise ValueError(f'Unknown split {split!r}')
+    t = time.time()
+    # Taichi runtimes cannot be forked, so workers start from scratch
+    context = multiprocessing.get_context('spawn')
+    # The pool must start outside runpy, which replaces __main__ that the
+    # spawned processes import
+    pool = context.Pool(workers - 1)
+    with tempfile.TemporaryDirectory() as tmp, pool:
+        voxels = os.path.join(tmp, 'scene.tivox')
+
+        def on_finish(scene):
+            scene.save(voxels)
+            pending = pool.starmap_async(
+                _render_partial,
+                [(script, i, workers, shares[i], split, voxels, options)
+                 for i in range(1, workers)])
+            t_render = time.perf_counter()
+            (color, luminance_sq, pixel_spp), busy = _render_share(
+                scene, 0, workers, shares[0], split)
+            for partial, seconds in pending.get():
+                color += partial[0]
+                luminance_sq += partial[1]
+                pixel_spp += partial[2]
+                busy += seconds
+            elapsed = time.perf_counter() - t_render
+            scene.renderer.set_accumulation(color, luminance_sq, pixel_spp)
+            scene.write_image(output)
+            # Rendering time of all processes relative to the wall-clock
+            # time they were given, 1.0 for perfectly linear scaling. Workers
+            # start, compile and load the voxels within that time.
+            print(f"Parallel efficiency {busy / (workers * elapsed):.2f} "
+                  f"({busy:.2f}s of rendering in {elapsed:.2f}s on "
+                  f"{workers} processes)")
+
+        with scene_overrides(headless=True,
+                             seed=0,
+                             on_finish=on_finish,
+                             **options):
+            runpy.run_path(script, run_name='__main__')
+    print(f"Rendered {spp} spp on {workers} processes split by {split} in "
+          f"{time.time() - t:.2f}s, saved to {output}")
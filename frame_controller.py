@@ -0,0 +1,131 @@
+import contextlib
+import time
+
+import taichi as ti
+
+TARGET_FPS = 30
+# Share of each frame reserved for path tracing. The rest, or the measured
+# present time if that is longer, is left for fetching, tone mapping and
+# showing the image.
+RENDER_FRACTION = 0.8
+# Weight of the newest measurement in the smoothed timings
+TIMING_SMOOTHING = 0.2
+# Frame time of a throughput-oriented run: long enough that presenting is
+# cheap compared to rendering, short enough to show progress
+THROUGHPUT_FRAME_TIME = 0.5
+# Partial frames end once a full sample fits in this share of the budget,
+# so that the controller does not flip between the two modes
+FULL_FRAME_HEADROOM = 0.5
+# Upper bound on samples per pixel in one frame
+MAX_SPP_PER_FRAME = 256
+
+
+class FrameController:
+    def __init__(self,
+                 scheduler,
+                 target_fps=TARGET_FPS,
+                 render_fraction=RENDER_FRACTION):
+        """
+        Choose how many samples per pixel each interactive frame renders
+        from smoothed timings of earlier frames. Rendering and presenting
+        are timed separately with ti.sync(), so asynchronous kernel launches
+        are charged to the frame that issued them. When even one sample
+        overruns the render budget, frames are rendered partially, tile by
+        tile, through `scheduler`.
+
+        The default target is latency (`target_fps`); see
+        set_throughput_target() for runs that only care about samples per
+        second.
+        """
+        self.scheduler = scheduler
+        self.renderer = scheduler.renderer
+        self.set_latency_target(target_fps, render_fraction)
+        # Seconds per full-frame sample, per quality preset, None until
+        # measured
+        self.sample_time = {}
+        self.present_time = None
+        self.partial_frames = False
+        self.samples = 0
+        self.render_seconds = 0.0
+        # The first call of each kind includes JIT compilation
+        self._measured = set()
+
+    def set_latency_target(self, target_fps=TARGET_FPS,
+                           render_fraction=RENDER_FRACTION):
+        self.frame_time = 1 / target_fps
+        self.render_fraction = render_fraction
+
+    def set_throughput_target(self, frame_time=THROUGHPUT_FRAME_TIME):
+        """
+        Render as many samples per second as possible: long frames with no
+        reserve beyond the measured present time, e.g. for timelapse
+        captures or headless renders.
+        """
+        self.frame_time = frame_time
+        self.render_fraction = 1.0
+
+    def render_budget(self):
+        present = max(self.present_time or 0.0,
+                      self.frame_time * (1 - self.render_fraction))
+        return self.frame_time - present
+
+    def samples_per_second(self):
+        # Full-frame samples per second of render time so far
+        if not self.render_seconds:
+            return 0.0
+        return self.samples / self.render_seconds
+
+    def _smooth(self, key, old, new):
+        if key not in self._measured:
+            self._measured.add(key)
+            return old
+        if old is None:
+            return new
+        return old + TIMING_SMOOTHING * (new - old)
+
+    def render(self, max_spp=None):
+        """
+        Render this frame's share of samples and return how many full-frame
+        samples it added (fractional for partial frames). Offline renders
+        pass `max_spp=` the samples they still need, which also restricts
+        the frame to whole samples.
+        """
+        budget = self.render_budget()
+        quality = self.renderer.quality
+        sample_time = self.sample_time.get(quality)
+        if not self.partial_frames and sample_time is not None:
+            self.partial_frames = sample_time > budget
+        ti.sync()
+        t = time.perf_counter()
+        if self.partial_frames and max_spp is None:
+            num_tiles = self.scheduler.render(budget)
+            samples = num_tiles / len(self.scheduler.tiles)
+            full_frame_time = self.scheduler.full_frame_time()
+            if full_frame_time:
+                self.sample_time[quality] = full_frame_time
+                self.partial_frames = (full_frame_time >
+                                       budget * FULL_FRAME_HEADROOM)
+        else:
+            spp = 1
+            if sample_time is not None:
+                spp = min(max(int(budget / sample_time), 1),
+                          max_spp or MAX_SPP_PER_FRAME)
+            for _ in range(spp):
+                self.renderer.accumulate()
+            ti.sync()
+            samples = spp
+            self.sample_time[quality] = self._smooth(
+                quality, sample_time, (time.perf_counter() - t) / spp)
+        self.samples += samples
+        self.render_seconds += time.perf_counter() - t
+        return samples
+
+    @contextlib.contextmanager
+    def present(self):
+        # Time the block that fetches and shows the image
+        ti.sync()
+        t = time.perf_counter()
+        yield
+        ti.sync()
+        self.present_time = self._smooth('present', self.present_time,
+                                         time.perf_counter() - t)
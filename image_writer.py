@@ -0,0 +1,117 @@
+import contextlib
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import types
+
+import taichi as ti
+
+# Images that may wait for encoding before write() blocks
+MAX_PENDING_IMAGES = 8
+# Seconds to encode a 1280x720 JPEG, and the rate at which the window
+# captures frames; the default number of writer processes keeps up with both
+ENCODE_SECONDS = 0.13
+CAPTURE_FPS = 30
+
+
+def default_num_writers(processes):
+    # imwrite holds the interpreter lock while it encodes, so threads encode
+    # one image at a time whatever their number; only processes add up
+    if not processes:
+        return 1
+    needed = math.ceil(ENCODE_SECONDS * CAPTURE_FPS)
+    # Leave a core for the render loop
+    return max(1, min(needed, (os.cpu_count() or 1) - 1))
+
+
+@contextlib.contextmanager
+def _without_main_module():
+    # Spawned processes import the main module first, which would run a
+    # scene script that is not guarded by `if __name__ == '__main__'` again
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _save(img, path):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    ti.tools.image.imwrite(img, path)
+
+
+class ImageWriter:
+    def __init__(self,
+                 max_pending=MAX_PENDING_IMAGES,
+                 num_threads=None,
+                 processes=False):
+        """
+        Encode and save images on background threads, so that disk I/O
+        overlaps with rendering. write() blocks once `max_pending` images
+        are waiting, which bounds host memory; callers that must not block
+        check full() first.
+
+        Encoding holds the interpreter lock and stalls the calling thread
+        for as long as it takes (about ENCODE_SECONDS). With
+        `processes=True` each thread hands its images to one of
+        `num_threads` spawned worker processes instead, by default enough
+        to encode frames at CAPTURE_FPS, so the caller keeps running.
+        """
+        if num_threads is None:
+            num_threads = default_num_writers(processes)
+        self._queue = queue.Queue(max_pending)
+        self._pool = None
+        if processes:
+            # Forking would copy the Taichi runtime of this process. The
+            # pool starts all of its processes right away.
+            with _without_main_module():
+                self._pool = multiprocessing.get_context('spawn').Pool(
+                    num_threads)
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self._pool is None:
+                    _save(*item)
+                else:
+                    self._pool.apply(_save, item)
+            except Exception as e:
+                print(f'Failed to save {item[1]}: {e}')
+
+    def write(self, img, path):
+        # img must be a host copy (e.g. field.to_numpy()), not a field that
+        # the renderer keeps writing to
+        self._queue.put((img, path))
+
+    def full(self):
+        return self._queue.full()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
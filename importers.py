@@ -0,0 +1,212 @@
+import struct
+
+import numpy as np
+
+from scene import MAT_LAMBERTIAN, MAT_LIGHT
+
+# Voxels decoded and uploaded per batch, which bounds peak host memory
+CHUNK_VOXELS = 1 << 20
+
+
+def _default_vox_palette():
+    # MagicaVoxel's built-in palette: a 6x6x6 color cube followed by red,
+    # green, blue and gray ramps. Entry 0 is unused.
+    levels = [0xff, 0xcc, 0x99, 0x66, 0x33, 0x00]
+    cube = [(r, g, b) for r in levels for g in levels for b in levels][:-1]
+    ramp = [0xee, 0xdd, 0xbb, 0xaa, 0x88, 0x77, 0x55, 0x44, 0x22, 0x11]
+    ramps = ([(v, 0, 0) for v in ramp] + [(0, v, 0) for v in ramp] +
+             [(0, 0, v) for v in ramp] + [(v, v, v) for v in ramp])
+    return np.array([(0, 0, 0)] + cube + ramps, dtype=np.uint8)
+
+
+def _read_string(data, pos):
+    n, = struct.unpack_from('<i', data, pos)
+    return data[pos + 4:pos + 4 + n].decode(), pos + 4 + n
+
+
+def _read_dict(data, pos):
+    n, = struct.unpack_from('<i', data, pos)
+    pos += 4
+    d = {}
+    for _ in range(n):
+        key, pos = _read_string(data, pos)
+        d[key], pos = _read_string(data, pos)
+    return d, pos
+
+
+class _VoxIndex:
+    """
+    Result of a first pass over a .vox file that reads the small chunks
+    (sizes, palette, materials, scene graph) and only records where the
+    voxel data of each model is.
+    """
+    def __init__(self, f):
+        if f.read(4) != b'VOX ':
+            raise ValueError('Not a MagicaVoxel file')
+        f.read(4)  # version
+        self.sizes = []
+        self.models = []  # (file offset, number of voxels)
+        self.palette = _default_vox_palette()
+        self.emissive = np.zeros(256, dtype=bool)
+        self.nodes = {}
+        chunk_id, content_size, children_size = struct.unpack(
+            '<4sii', f.read(12))
+        if chunk_id != b'MAIN':
+            raise ValueError('Missing MAIN chunk')
+        end = f.tell() + content_size + children_size
+        f.seek(content_size, 1)
+        while f.tell() < end:
+            chunk_id, content_size, children_size = struct.unpack(
+                '<4sii', f.read(12))
+            start = f.tell()
+            if chunk_id == b'XYZI':
+                num_voxels, = struct.unpack('<i', f.read(4))
+                self.models.append((f.tell(), num_voxels))
+            elif chunk_id in (b'SIZE', b'RGBA', b'MATL', b'nTRN', b'nGRP',
+                              b'nSHP'):
+                self._parse(chunk_id, f.read(content_size))
+            f.seek(start + content_size + children_size)
+
+    def _parse(self, chunk_id, data):
+        if chunk_id == b'SIZE':
+            x, y, z = struct.unpack('<3i', data[:12])
+            self.sizes.append((x, y, z))
+        elif chunk_id == b'RGBA':
+            rgba = np.frombuffer(data, dtype=np.uint8).reshape(256, 4)
+            # Color index i refers to the (i - 1)-th RGBA entry
+            self.palette = np.concatenate(
+                [np.zeros((1, 3), dtype=np.uint8), rgba[:255, :3]])
+        elif chunk_id == b'MATL':
+            material_id, = struct.unpack_from('<i', data)
+            properties, _ = _read_dict(data, 4)
+            if properties.get('_type') == '_emit' and 0 < material_id < 256:
+                self.emissive[material_id] = True
+        else:
+            node_id, = struct.unpack_from('<i', data)
+            _, pos = _read_dict(data, 4)  # node attributes
+            if chunk_id == b'nTRN':
+                # child id, reserved, layer id, number of frames, then the
+                # first frame's attributes
+                child, = struct.unpack_from('<i', data, pos)
+                frame, _ = _read_dict(data, pos + 16)
+                translation = frame.get('_t', '0 0 0').split()
+                self.nodes[node_id] = ('transform', child,
+                                       [int(v) for v in translation])
+            elif chunk_id == b'nGRP':
+                n, = struct.unpack_from('<i', data, pos)
+                children = struct.unpack_from(f'<{n}i', data, pos + 4)
+                self.nodes[node_id] = ('group', children)
+            else:
+                n, = struct.unpack_from('<i', data, pos)
+                pos += 4
+                models = []
+                for _ in range(n):
+                    model, = struct.unpack_from('<i', data, pos)
+                    _, pos = _read_dict(data, pos + 4)
+                    models.append(model)
+                self.nodes[node_id] = ('shape', models)
+
+    def model_origins(self):
+        """
+        Return the position of voxel (0, 0, 0) of each model, in .vox
+        coordinates. Only translations of the scene graph are applied;
+        rotations are ignored.
+        """
+        origins = [None] * len(self.models)
+
+        def visit(node_id, translation):
+            node = self.nodes[node_id]
+            if node[0] == 'transform':
+                visit(node[1], translation + np.array(node[2]))
+            elif node[0] == 'group':
+                for child in node[1]:
+                    visit(child, translation)
+            else:
+                for model in node[1]:
+                    # Translations refer to the center of a model
+                    origins[model] = translation - np.array(
+                        self.sizes[model]) // 2
+
+        if self.nodes:
+            visit(0, np.zeros(3, dtype=np.int64))
+        return [
+            np.zeros(3, dtype=np.int64) if origin is None else origin
+            for origin in origins
+        ]
+
+
+def _vox_to_grid(xyz):
+    # MagicaVoxel is right-handed with z up, the renderer uses y up
+    return np.stack([xyz[:, 0], xyz[:, 2], -xyz[:, 1]], axis=1)
+
+
+def load_vox(renderer, path, offset=None):
+    """
+    Stream the models of a MagicaVoxel .vox file into `renderer`. Voxels
+    are decoded and uploaded CHUNK_VOXELS at a time with
+    set_voxels_from_numpy(), so host memory stays bounded for large
+    models. Palette colors map to the renderer's u8 colors, and palette
+    entries with an emissive material become MAT_LIGHT voxels.
+
+    Without an `offset`, the scene is centered in the grid; otherwise
+    `offset` is added to the (y-up) voxel coordinates of the file.
+    """
+    with open(path, 'rb') as f:
+        index = _VoxIndex(f)
+        origins = index.model_origins()
+        if offset is None:
+            lo = np.min([_vox_to_grid(np.array([o, o + s - 1])).min(axis=0)
+                         for o, s in zip(origins, index.sizes)], axis=0)
+            hi = np.max([_vox_to_grid(np.array([o, o + s - 1])).max(axis=0)
+                         for o, s in zip(origins, index.sizes)], axis=0)
+            offset = -(lo + hi) // 2
+        offset = tuple(int(v) for v in offset)
+        materials = np.where(index.emissive, MAT_LIGHT,
+                             MAT_LAMBERTIAN).astype(np.int8)
+        for (start, num_voxels), origin in zip(index.models, origins):
+            f.seek(start)
+            for begin in range(0, num_voxels, CHUNK_VOXELS):
+                n = min(CHUNK_VOXELS, num_voxels - begin)
+                data = np.frombuffer(f.read(n * 4),
+                                     dtype=np.uint8).reshape(n, 4)
+                coords = _vox_to_grid(data[:, :3].astype(np.int64) + origin)
+                renderer.set_voxels_from_numpy(materials[data[:, 3]],
+                                               index.palette[data[:, 3]],
+                                               offset=offset,
+                                               coords=coords)
+
+
+def load_raw(renderer,
+             path,
+             shape,
+             dtype=np.uint8,
+             threshold=1,
+             color=None,
+             offset=None):
+    """
+    Stream a raw volume (a headerless C-order array of `shape` = (X, Y, Z)
+    and `dtype`, with y up) into `renderer`, one memory-mapped X slab at a
+    time. Values >= `threshold` become MAT_LAMBERTIAN voxels, colored
+    `color` (u8 RGB) or, by default, gray by value. The volume is centered
+    in the grid unless an `offset` is given.
+    """
+    volume = np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+    if offset is None:
+        offset = tuple(-(n // 2) for n in shape)
+    vmax = max(float(volume.max()), 1e-9)
+    slab = max(1, CHUNK_VOXELS // (shape[1] * shape[2]))
+    for x0 in range(0, shape[0], slab):
+        block = np.asarray(volume[x0:x0 + slab])
+        coords = np.argwhere(block >= threshold)
+        values = block[tuple(coords.T)]
+        coords[:, 0] += x0
+        if color is None:
+            gray = (values.astype(np.float64) / vmax * 255).astype(np.uint8)
+            colors = np.repeat(gray[:, None], 3, axis=1)
+        else:
+            colors = np.tile(np.array(color, dtype=np.uint8),
+                             (len(coords), 1))
+        renderer.set_voxels_from_numpy(np.full(len(coords), MAT_LAMBERTIAN),
+                                       colors,
+                                       offset=offset,
+                                       coords=coords)
@@ -0,0 +1,176 @@
+import collections
+import contextlib
+import json
+import time
+
+import taichi as ti
+
+# Kernel launches shown in the HUD, slowest first
+HUD_KERNELS = 6
+# Most recent events kept for the Chrome trace; older ones only count
+# towards the per-name statistics
+MAX_TRACE_EVENTS = 100000
+
+
+def _add_event(stats, name, category, duration):
+    if category == 'compile':
+        name = f'{name} (compile)'
+    s = stats.setdefault(name, {
+        'category': category,
+        'calls': 0,
+        'total_s': 0.0,
+        'max_s': 0.0
+    })
+    s['calls'] += 1
+    s['total_s'] += duration
+    s['max_s'] = max(s['max_s'], duration)
+
+
+class Profiler:
+    def __init__(self):
+        """
+        Record the wall time of every Taichi kernel launch and of named
+        scopes, plus the renderer's device counters. Kernels are timed with
+        ti.sync() before and after each launch, which serializes them: the
+        numbers are per-kernel costs, not the throughput of an unprofiled
+        run.
+        """
+        # (name, category, start, duration) in seconds
+        self.events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        self.counters = collections.Counter()
+        self._stats = {}  # Per-name statistics of all events
+        # Events of the current frame, once begin_frame() has been called
+        self._frame_events = None
+        self._start = time.perf_counter()
+        self._original_call = None
+
+    def install(self):
+        """
+        Time all kernel launches, including user kernels, until uninstall().
+        """
+        if self._original_call is not None:
+            return
+        # Taichi's internals are only touched when profiling is enabled
+        from taichi.lang.kernel_impl import Kernel
+        original_call = self._original_call = Kernel.__call__
+        profiler = self
+
+        def call(kernel, *args, **kwargs):
+            num_compiled = len(kernel.compiled_kernels)
+            ti.sync()
+            t = time.perf_counter()
+            result = original_call(kernel, *args, **kwargs)
+            ti.sync()
+            # Launches that compiled a new variant are kept apart, so that
+            # JIT time does not skew the kernel's statistics
+            category = ('compile' if len(kernel.compiled_kernels) >
+                        num_compiled else 'kernel')
+            profiler.record(kernel.func.__name__, category, t,
+                            time.perf_counter() - t)
+            return result
+
+        Kernel.__call__ = call
+
+    def uninstall(self):
+        if self._original_call is not None:
+            from taichi.lang.kernel_impl import Kernel
+            Kernel.__call__ = self._original_call
+            self._original_call = None
+
+    def record(self, name, category, start, duration):
+        event = (name, category, start - self._start, duration)
+        self.events.append(event)
+        if self._frame_events is not None:
+            self._frame_events.append(event)
+        _add_event(self._stats, name, category, duration)
+
+    @contextlib.contextmanager
+    def scope(self, name, category='scope'):
+        ti.sync()
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            ti.sync()
+            self.record(name, category, t, time.perf_counter() - t)
+
+    def add_counters(self, counters):
+        self.counters.update(counters)
+
+    def begin_frame(self):
+        self._frame_events = []
+
+    def frame_events(self):
+        # Events recorded since the last begin_frame()
+        return self._frame_events or []
+
+    def derived_counters(self):
+        """
+        Return averages of the device counters per ray or path.
+        """
+        c = self.counters
+        derived = {}
+        if c['rays']:
+            derived['dda_steps_per_ray'] = c['dda_steps'] / c['rays']
+        if c['paths']:
+            derived['bounces_per_path'] = c['bounces'] / c['paths']
+            derived['shadow_rays_per_path'] = c['shadow_rays'] / c['paths']
+            derived['rr_terminations_per_path'] = (c['rr_terminations'] /
+                                                   c['paths'])
+        return derived
+
+    def summary(self, events=None):
+        """
+        Return per-name statistics of `events` (default: all events of the
+        session, including those no longer kept for the trace) and derived
+        averages of the device counters.
+        """
+        if events is None:
+            stats = {name: dict(s) for name, s in self._stats.items()}
+        else:
+            stats = {}
+            for name, category, _, duration in events:
+                _add_event(stats, name, category, duration)
+        for s in stats.values():
+            s['mean_s'] = s['total_s'] / s['calls']
+        return {
+            'timings': dict(
+                sorted(stats.items(), key=lambda item: -item[1]['total_s'])),
+            'counters': dict(self.counters),
+            'derived': self.derived_counters(),
+        }
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_chrome_trace(self, path):
+        """
+        Write the last MAX_TRACE_EVENTS events in the Trace Event Format,
+        which chrome://tracing and https://ui.perfetto.dev open.
+        """
+        trace = [{
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': duration * 1e6,
+            'pid': 0,
+            'tid': 0 if category == 'scope' else 1,
+        } for name, category, start, duration in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace}, f)
+
+    def hud_lines(self):
+        """
+        Text for an overlay: the slowest kernels of the current frame and
+        the counter averages so far.
+        """
+        summary = self.summary(self.frame_events())
+        lines = []
+        for name, s in list(summary['timings'].items())[:HUD_KERNELS]:
+            lines.append(f"{name}: {s['total_s'] * 1e3:.2f} ms"
+                         f" ({s['calls']}x)")
+        for name, value in self.derived_counters().items():
+            lines.append(f'{name}: {value:.2f}')
+        return lines
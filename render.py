@@ -0,0 +1,79 @@
+import argparse
+import os
+import runpy
+
+import taichi as ti
+
+from animation import turntable
+from distributed import render_distributed
+from scene import scene_overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render a voxel scene script to an image without a window.')
+    parser.add_argument('script', help='scene script, e.g. example1.py')
+    parser.add_argument('--spp', type=int, default=64)
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--noise-threshold', type=float, default=None,
+                        help='stop early once every pixel is this noisy or '
+                        'less; --spp is then the upper bound')
+    parser.add_argument('--arch', default='cpu',
+                        help='taichi backend, e.g. cpu, cuda, vulkan')
+    parser.add_argument('--res', type=int, nargs=2, default=None,
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--warm-up', action='store_true',
+                        help='compile the renderer before generating voxels '
+                        'and print startup timings')
+    parser.add_argument('--offline-cache', default=None, metavar='PATH',
+                        help="directory of Taichi's offline kernel cache")
+    parser.add_argument('--turntable', type=int, default=0, metavar='FRAMES',
+                        help='render an orbit around the scene to '
+                        '<output>-NNNN.png frames instead of one image')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='split the samples across this many processes')
+    parser.add_argument('--split', choices=('samples', 'tiles'),
+                        default='samples',
+                        help='give each of the --workers a share of the '
+                        'samples of every pixel, or all samples of a subset '
+                        'of the tiles')
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help='write per-kernel timings and device counters '
+                        'to PATH (JSON) and a Chrome trace next to it')
+    args = parser.parse_args()
+    if args.workers > 1:
+        # Workers only render a fixed number of samples of a single view
+        for flag, value in (('--noise-threshold', args.noise_threshold),
+                            ('--turntable', args.turntable),
+                            ('--profile', args.profile)):
+            if value:
+                parser.error(f'{flag} cannot be combined with --workers')
+
+    output = args.output or os.path.splitext(os.path.basename(
+        args.script))[0] + '.png'
+    options = dict(arch=getattr(ti, args.arch),
+                   warm_up=args.warm_up,
+                   print_startup_timings=args.warm_up,
+                   offline_cache_path=args.offline_cache)
+    if args.res:
+        options['image_res'] = tuple(args.res)
+    if args.workers > 1:
+        render_distributed(args.script, args.workers, args.spp, output,
+                           split=args.split, **options)
+        return
+    if args.profile:
+        options['profile_output'] = args.profile
+    if args.turntable:
+        stem, ext = os.path.splitext(output)
+        options['on_finish'] = lambda scene: scene.render_animation(
+            turntable(args.turntable), stem + '-{:04d}' + ext)
+    with scene_overrides(headless=True,
+                         spp=args.spp,
+                         output=output,
+                         noise_threshold=args.noise_threshold,
+                         **options):
+        runpy.run_path(args.script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import numpy as np
 import taichi as ti
 
 from math_utils import (eps, inf, out_dir, ray_aabb_intersection)
@@ -5,12 +6,88 @@ from math_utils import (eps, inf, out_dir, ray_aabb_intersection)
 MAX_RAY_DEPTH = 4
 use_directional_light = True
 
+# Path depth of each quality preset. The kernels take it as a template
+# argument, so each preset is a separately compiled variant and switching
+# between them does not recompile anything once warm. The light model is
+# the same in every preset: rendering the sun without shadow rays made the
+# megakernel slower on CPU, not faster.
+QUALITY_PRESETS = {
+    'preview': dict(max_ray_depth=2),
+    'interactive': dict(max_ray_depth=3),
+    'final': dict(max_ray_depth=MAX_RAY_DEPTH),
+}
+
 DIS_LIMIT = 100
 
+# Rec. 709 luminance weights, used for per-pixel noise estimates
+LUMINANCE = (0.2126, 0.7152, 0.0722)
+
+# Events counted on the device with `profile_counters=True`
+COUNTERS = ('rays', 'dda_steps', 'paths', 'bounces', 'shadow_rays',
+            'rr_terminations')
+
+# Brick sizes (in voxels) of the occupancy pyramid, finest first
+OCCUPANCY_BRICK_SIZES = (8, 32)
+
+# Voxels per block edge of the sparse layout's pointer level
+SPARSE_BLOCK_SIZE = 8
+
+# Bit layout of packed voxel words (voxel_storage='packed') and of baked
+# surface records (surface_cache=True): 8-bit RGB in the low bytes, the
+# material in the top byte
+SURFACE_MATERIAL_SHIFT = 24
+
+# How the color and material of each voxel are stored: side by side in one
+# struct ('aos'), in separate arrays ('soa'), or as one u32 word ('packed')
+VOXEL_STORAGES = ('aos', 'soa', 'packed')
+
+# Order of voxels (and occupancy bricks) in memory for the dense layout:
+# row-major ('linear'), row-major VOXEL_BLOCK_SIZE^3 blocks of row-major
+# voxels ('blocked'), or a Z-order curve ('morton'), which keeps neighbors
+# close along every axis
+VOXEL_ORDERS = ('linear', 'blocked', 'morton')
+VOXEL_BLOCK_SIZE = 8
+
+# Samples per pixel kept when reprojecting across camera moves, so that
+# resampling errors fade out instead of building up
+REPROJECTION_MAX_SPP = 32
+# History is rejected when the surface normal turns by more than this
+# (cosine), or the surface moves off its plane by more than this (voxels)
+REPROJECTION_NORMAL_COS = 0.9
+REPROJECTION_PLANE_DISTANCE = 0.25
+
+# Edge-aware a-trous denoiser: filter passes (the footprint doubles with
+# each), and how fast the weights fall off with luminance difference (in
+# standard deviations), plane distance (in voxels) and normal angle (a power
+# of two)
+DENOISE_ITERATIONS = 5
+DENOISE_SIGMA_LUMINANCE = 4.0
+DENOISE_SIGMA_PLANE = 0.5
+DENOISE_NORMAL_POWER = 64
+# Below this many samples, a pixel's variance is estimated from its
+# neighbors instead of its own samples
+DENOISE_MIN_SPP = 4
+
 
 @ti.data_oriented
 class Renderer:
-    def __init__(self, dx, image_res, up, voxel_edges, exposure=3):
+    def __init__(self,
+                 dx,
+                 image_res,
+                 up,
+                 voxel_edges,
+                 exposure=3,
+                 hierarchical_dda=False,
+                 voxel_layout='dense',
+                 grid_res=128,
+                 reprojection=False,
+                 denoise=False,
+                 path_tracer='megakernel',
+                 quality='final',
+                 profile_counters=False,
+                 surface_cache=False,
+                 voxel_storage='aos',
+                 voxel_order='linear'):
         self.image_res = image_res
         self.aspect_ratio = image_res[0] / image_res[1]
         self.vignette_strength = 0.9
@@ -19,10 +96,21 @@ class Renderer:
         self.current_spp = 0
 
         self.color_buffer = ti.Vector.field(3, dtype=ti.f32)
+        # Per-pixel sum of squared sample luminance, sample count, and
+        # whether the pixel still receives samples (see update_convergence)
+        self.luminance_sq_buffer = ti.field(dtype=ti.f32)
+        self.pixel_spp = ti.field(dtype=ti.i32)
+        self.pixel_active = ti.field(dtype=ti.i8)
         self.bbox = ti.Vector.field(3, dtype=ti.f32, shape=2)
         self.fov = ti.field(dtype=ti.f32, shape=())
-        self.voxel_color = ti.Vector.field(3, dtype=ti.u8)
-        self.voxel_material = ti.field(dtype=ti.i8)
+        if voxel_storage not in VOXEL_STORAGES:
+            raise ValueError(f'Unknown voxel storage: {voxel_storage}')
+        self.voxel_storage = voxel_storage
+        if voxel_storage == 'packed':
+            self.voxel_data = ti.field(dtype=ti.u32)
+        else:
+            self.voxel_color = ti.Vector.field(3, dtype=ti.u8)
+            self.voxel_material = ti.field(dtype=ti.i8)
 
         self.light_direction = ti.Vector.field(3, dtype=ti.f32, shape=())
         self.light_direction_noise = ti.field(dtype=ti.f32, shape=())
@@ -33,6 +121,30 @@ class Renderer:
 
         self.voxel_edges = voxel_edges
         self.exposure = exposure
+        self.hierarchical_dda = hierarchical_dda
+        self.reprojection = reprojection
+        self.denoise = denoise
+        self.path_tracer = path_tracer
+        self.directional_light = use_directional_light
+        self.set_quality(quality)
+        # Counters are compiled out unless enabled. The device counters are
+        # i32, which one frame of many samples per pixel can overflow, so
+        # render() and render_tile() drain them into 64-bit host totals
+        # after every launch.
+        self.profile_counters = profile_counters
+        self.counters = ti.field(dtype=ti.i32, shape=len(COUNTERS))
+        self._counter_totals = np.zeros(len(COUNTERS), dtype=np.int64)
+        # Whether render() records the first hit of each pixel
+        self.gbuffer = reprojection or denoise
+        # Whether hits are shaded from voxel_surface, one packed word per
+        # voxel that flush_voxel_edits() bakes from the color and material.
+        # Packed voxels already are such words.
+        self.surface_cache = surface_cache or voxel_storage == 'packed'
+        self._baked_surfaces = surface_cache and voxel_storage != 'packed'
+        if voxel_storage == 'packed':
+            self.voxel_surface = self.voxel_data
+        elif self._baked_surfaces:
+            self.voxel_surface = ti.field(dtype=ti.u32)
 
         self.camera_pos = ti.Vector.field(3, dtype=ti.f32, shape=())
         self.look_at = ti.Vector.field(3, dtype=ti.f32, shape=())
@@ -46,22 +158,136 @@ class Renderer:
         self.voxel_dx = dx
         self.voxel_inv_dx = 1 / dx
         # Note that voxel_inv_dx == voxel_grid_res iff the box has width = 1
-        self.voxel_grid_res = 128
+        # Python attributes like these are compiled into the kernels as
+        # constants, so the resolution costs nothing per ray.
+        if grid_res % max(OCCUPANCY_BRICK_SIZES + (SPARSE_BLOCK_SIZE, )):
+            raise ValueError(
+                f'Grid resolution must be a multiple of '
+                f'{max(OCCUPANCY_BRICK_SIZES)}, got {grid_res}')
+        self.voxel_grid_res = grid_res
         voxel_grid_offset = [-self.voxel_grid_res // 2 for _ in range(3)]
 
-        ti.root.dense(ti.ij, image_res).place(self.color_buffer)
-        ti.root.dense(ti.ijk,
-                      self.voxel_grid_res).place(self.voxel_color,
-                                                 self.voxel_material,
-                                                 offset=voxel_grid_offset)
+        ti.root.dense(ti.ij, image_res).place(self.color_buffer,
+                                              self.luminance_sq_buffer,
+                                              self.pixel_spp,
+                                              self.pixel_active)
+        if self.gbuffer:
+            # First hit of the current view; a zero normal marks the
+            # background, whose albedo is 1
+            self.gbuffer_position = ti.Vector.field(3, dtype=ti.f32)
+            self.gbuffer_normal = ti.Vector.field(3, dtype=ti.f32)
+            self.gbuffer_albedo = ti.Vector.field(3, dtype=ti.f32)
+            ti.root.dense(ti.ij, image_res).place(self.gbuffer_position,
+                                                  self.gbuffer_normal,
+                                                  self.gbuffer_albedo)
+        if reprojection:
+            # Accumulation of the previous view
+            self.history_color = ti.Vector.field(3, dtype=ti.f32)
+            self.history_luminance_sq = ti.field(dtype=ti.f32)
+            self.history_spp = ti.field(dtype=ti.i32)
+            self.history_position = ti.Vector.field(3, dtype=ti.f32)
+            self.history_normal = ti.Vector.field(3, dtype=ti.f32)
+            ti.root.dense(ti.ij, image_res).place(
+                self.history_color, self.history_luminance_sq,
+                self.history_spp, self.history_position, self.history_normal)
+            # Camera that the accumulated samples were rendered with
+            self.view_camera_pos = ti.Vector.field(3, dtype=ti.f32, shape=())
+            self.view_look_at = ti.Vector.field(3, dtype=ti.f32, shape=())
+            self.view_fov = ti.field(dtype=ti.f32, shape=())
+            self._view_stored = False
+        if denoise:
+            # Ping-pong buffers of demodulated illumination and its variance
+            self._denoise_color = [
+                ti.Vector.field(3, dtype=ti.f32, shape=image_res)
+                for _ in range(2)
+            ]
+            self._denoise_variance = [
+                ti.field(dtype=ti.f32, shape=image_res) for _ in range(2)
+            ]
+        if path_tracer == 'wavefront':
+            self._allocate_wavefront_queues()
+        elif path_tracer != 'megakernel':
+            raise ValueError(f'Unknown path tracer: {path_tracer}')
+        self.voxel_layout = voxel_layout
+        if voxel_order not in VOXEL_ORDERS:
+            raise ValueError(f'Unknown voxel order: {voxel_order}')
+        if voxel_order == 'morton' and grid_res & (grid_res - 1):
+            raise ValueError(f'Morton order needs a power of two grid '
+                             f'resolution, got {grid_res}')
+        if voxel_layout == 'sparse' and voxel_order != 'linear':
+            raise ValueError('The sparse layout is already blocked; '
+                             'voxel_order only applies to dense voxels')
+        self.voxel_order = voxel_order
+        if voxel_layout == 'sparse':
+            # Only blocks containing written voxels are allocated; reading an
+            # inactive voxel yields 0, i.e. empty space.
+            self._voxel_blocks = ti.root.pointer(
+                ti.ijk, self.voxel_grid_res // SPARSE_BLOCK_SIZE)
+        elif voxel_layout != 'dense':
+            raise ValueError(f'Unknown voxel layout: {voxel_layout}')
+        if voxel_storage == 'aos':
+            groups = [(self.voxel_color, self.voxel_material)]
+        elif voxel_storage == 'soa':
+            groups = [(self.voxel_color, ), (self.voxel_material, )]
+        else:
+            groups = [(self.voxel_data, )]
+        if self._baked_surfaces:
+            groups.append((self.voxel_surface, ))
+        for fields in groups:
+            self._voxel_leaf().place(*fields, offset=voxel_grid_offset)
+        # Field whose indices enumerate the voxels, for struct-for loops
+        self._voxels = groups[0][-1]
+
+        # occupancy[l][b] != 0 if brick b of size OCCUPANCY_BRICK_SIZES[l]
+        # contains a non-empty voxel. set_voxel() keeps it (and the bbox)
+        # conservative; flush_voxel_edits() tightens both after clears.
+        self.occupancy = []
+        for size in OCCUPANCY_BRICK_SIZES:
+            occupancy = ti.field(dtype=ti.i8)
+            n = self.voxel_grid_res // size
+            # Matches _to_brick_index(); (-n) // 2 would be -1 for n = 1
+            self._grid_leaf(n).place(occupancy,
+                                     offset=[-(n // 2) for _ in range(3)])
+            self.occupancy.append(occupancy)
+
+        # Finest-level bricks touched by set_voxel() since the last flush
+        self.dirty_bricks = ti.field(dtype=ti.i8)
+        n = self.voxel_grid_res // OCCUPANCY_BRICK_SIZES[0]
+        ti.root.dense(ti.ijk, n).place(self.dirty_bricks,
+                                       offset=[-(n // 2) for _ in range(3)])
+        self.voxels_dirty = ti.field(ti.i32, shape=())
+        self.bbox_stale = ti.field(ti.i32, shape=())
+        self.bbox[0] = [1e9, 1e9, 1e9]
+        self.bbox[1] = [-1e9, -1e9, -1e9]
 
         self._rendered_image = ti.Vector.field(3, float, image_res)
+        self.pixel_active.fill(1)
         self.set_up(*up)
         self.set_fov(0.23)
 
         self.floor_height[None] = 0
         self.floor_color[None] = (1, 1, 1)
 
+    def _voxel_leaf(self):
+        # A fresh SNode of voxel resolution to place voxel fields in
+        if self.voxel_layout == 'sparse':
+            return self._voxel_blocks.bitmasked(ti.ijk, SPARSE_BLOCK_SIZE)
+        return self._grid_leaf(self.voxel_grid_res)
+
+    def _grid_leaf(self, n):
+        # A fresh dense n^3 SNode in the memory order of voxel_order.
+        # Grids too small to block fall back to row-major order.
+        if self.voxel_order == 'morton' and n > 1:
+            node = ti.root
+            for _ in range(n.bit_length() - 1):
+                node = node.dense(ti.ijk, 2)
+            return node
+        if (self.voxel_order == 'blocked' and n > VOXEL_BLOCK_SIZE
+                and n % VOXEL_BLOCK_SIZE == 0):
+            return ti.root.dense(ti.ijk, n // VOXEL_BLOCK_SIZE).dense(
+                ti.ijk, VOXEL_BLOCK_SIZE)
+        return ti.root.dense(ti.ijk, n)
+
     def set_directional_light(self, direction, light_direction_noise,
                               light_color):
         direction_norm = (direction[0]**2 + direction[1]**2 +
@@ -77,12 +303,40 @@ class Renderer:
         return ipos.min() >= -self.voxel_grid_res // 2 and ipos.max(
         ) < self.voxel_grid_res // 2
 
+    @ti.func
+    def _voxel_material(self, I):
+        mat = ti.i8(0)
+        if ti.static(self.voxel_storage == 'packed'):
+            mat = ti.cast(self.voxel_data[I] >> SURFACE_MATERIAL_SHIFT, ti.i8)
+        else:
+            mat = self.voxel_material[I]
+        return mat
+
+    @ti.func
+    def _voxel_color(self, I):
+        # 8-bit RGB
+        color = ti.Vector([ti.u8(0), ti.u8(0), ti.u8(0)])
+        if ti.static(self.voxel_storage == 'packed'):
+            data = self.voxel_data[I]
+            for i in ti.static(range(3)):
+                color[i] = ti.cast((data >> (8 * i)) & 0xFF, ti.u8)
+        else:
+            color = self.voxel_color[I]
+        return color
+
+    @ti.func
+    def _pack_voxel(self, mat, color_u8):
+        word = ti.cast(ti.cast(mat, ti.u8), ti.u32) << SURFACE_MATERIAL_SHIFT
+        for i in ti.static(range(3)):
+            word |= ti.cast(color_u8[i], ti.u32) << (8 * i)
+        return word
+
     @ti.func
     def query_density(self, ipos):
         inside = self.inside_grid(ipos)
         ret = 0.0
         if inside:
-            ret = self.voxel_material[ipos]
+            ret = self._voxel_material(ipos)
         else:
             ret = 0.0
         return ret
@@ -93,6 +347,18 @@ class Renderer:
         voxel_index = ti.floor(p).cast(ti.i32)
         return voxel_index
 
+    @ti.func
+    def _to_brick_index(self, ipos, size: ti.template()):
+        # Shift to non-negative indices first as integer division truncates
+        half = self.voxel_grid_res // 2
+        return (ipos + half) // size - half // size
+
+    @ti.func
+    def _brick_origin(self, B, size: ti.template()):
+        # First voxel of brick B, the inverse of _to_brick_index()
+        half = self.voxel_grid_res // 2
+        return (B + half // size) * size - half
+
     @ti.func
     def voxel_surface_color(self, pos):
         p = pos * self.voxel_inv_dx
@@ -111,9 +377,19 @@ class Renderer:
 
         voxel_color = ti.Vector([0.0, 0.0, 0.0])
         is_light = 0
-        if self.inside_particle_grid(voxel_index):
-            voxel_color = self.voxel_color[voxel_index] * (1.0 / 255)
-            if self.voxel_material[voxel_index] == 2:
+        if ti.static(self.surface_cache):
+            # Hits lie next to occupied voxels, so the cheaper grid test
+            # selects the same voxels as the bbox test below
+            if self.inside_grid(voxel_index):
+                record = self.voxel_surface[voxel_index]
+                for i in ti.static(range(3)):
+                    voxel_color[i] = ti.cast((record >> (8 * i)) & 0xFF,
+                                             ti.f32) * (1.0 / 255)
+                if record >> SURFACE_MATERIAL_SHIFT == 2:
+                    is_light = 1
+        elif self.inside_particle_grid(voxel_index):
+            voxel_color = self._voxel_color(voxel_index) * (1.0 / 255)
+            if self._voxel_material(voxel_index) == 2:
                 is_light = 1
 
         return voxel_color * (1.3 - 1.2 * f), is_light
@@ -134,7 +410,10 @@ class Renderer:
         return self.floor_color[None]
 
     @ti.func
-    def dda_voxel(self, eye_pos, d):
+    def _dda_march(self, eye_pos, d):
+        # Step through the voxel grid until the first occupied voxel.
+        # Returns whether one was hit, its distance and the normal of the
+        # face the ray entered through.
         for i in ti.static(range(3)):
             if abs(d[i]) < 1e-6:
                 d[i] = 1e-6
@@ -150,11 +429,10 @@ class Renderer:
         bbox_max = self.bbox[1]
         inter, near, far = ray_aabb_intersection(bbox_min, bbox_max, eye_pos,
                                                  d)
+        hit = 0
         hit_distance = inf
-        hit_light = 0
         normal = ti.Vector([0.0, 0.0, 0.0])
-        c = ti.Vector([0.0, 0.0, 0.0])
-        voxel_index = ti.Vector([0, 0, 0])
+        steps = 0
         if inter:
             near = max(0, near)
 
@@ -165,7 +443,6 @@ class Renderer:
             dis = (ipos - o + 0.5 + rsign * 0.5) * rinv
             running = 1
             i = 0
-            hit_pos = ti.Vector([0.0, 0.0, 0.0])
             while running:
                 last_sample = int(self.query_density(ipos))
                 if not self.inside_particle_grid(ipos):
@@ -175,24 +452,93 @@ class Renderer:
                     mini = (ipos - o + ti.Vector([0.5, 0.5, 0.5]) -
                             rsign * 0.5) * rinv
                     hit_distance = mini.max() * self.voxel_dx + near
-                    hit_pos = eye_pos + (hit_distance + 1e-3) * d
-                    voxel_index = self._to_voxel_index(hit_pos)
-                    c, hit_light = self.voxel_surface_color(hit_pos)
+                    hit = 1
                     running = 0
                 else:
-                    mm = ti.Vector([0, 0, 0])
-                    if dis[0] <= dis[1] and dis[0] < dis[2]:
-                        mm[0] = 1
-                    elif dis[1] <= dis[0] and dis[1] <= dis[2]:
-                        mm[1] = 1
-                    else:
-                        mm[2] = 1
-                    dis += mm * rsign * rinv
-                    ipos += mm * rsign
-                    normal = -mm * rsign
+                    skipped = 0
+                    if ti.static(self.hierarchical_dda):
+                        skipped, ipos, dis, normal = self._skip_empty_brick(
+                            o, d, rinv, rsign, ipos, dis, normal)
+                    if not skipped:
+                        mm = ti.Vector([0, 0, 0])
+                        if dis[0] <= dis[1] and dis[0] < dis[2]:
+                            mm[0] = 1
+                        elif dis[1] <= dis[0] and dis[1] <= dis[2]:
+                            mm[1] = 1
+                        else:
+                            mm[2] = 1
+                        dis += mm * rsign * rinv
+                        ipos += mm * rsign
+                        normal = -mm * rsign
                 i += 1
+            steps = i
+        self._count('rays', 1)
+        self._count('dda_steps', steps)
+        return hit, hit_distance, normal
+
+    @ti.func
+    def _count(self, name: ti.template(), amount):
+        if ti.static(self.profile_counters):
+            self.counters[ti.static(COUNTERS.index(name))] += amount
+
+    @ti.func
+    def dda_voxel(self, eye_pos, d):
+        hit, hit_distance, normal = self._dda_march(eye_pos, d)
+        hit_light = 0
+        c = ti.Vector([0.0, 0.0, 0.0])
+        voxel_index = ti.Vector([0, 0, 0])
+        if hit:
+            hit_pos = eye_pos + (hit_distance + 1e-3) * d
+            voxel_index = self._to_voxel_index(hit_pos)
+            c, hit_light = self.voxel_surface_color(hit_pos)
         return hit_distance, normal, c, hit_light, voxel_index
 
+    @ti.func
+    def occluded(self, pos, d):
+        # Whether a ray hits anything before DIS_LIMIT, i.e. the any-hit
+        # version of next_hit(): the cheap floor test comes first, and the
+        # voxel march stops at the first occupied voxel without shading it
+        blocked = 0
+        if self.ray_march(pos, d) < DIS_LIMIT:
+            blocked = 1
+        else:
+            blocked, _, _ = self._dda_march(pos, d)
+        return blocked
+
+    @ti.func
+    def _skip_empty_brick(self, o, d, rinv, rsign, ipos, dis, normal):
+        # Move ipos to the first voxel past the coarsest empty brick
+        # containing it, in a single step. Occupied fine bricks (the common
+        # case inside geometry) cost a single lookup.
+        skipped = 0
+        if self.inside_grid(ipos) and self.occupancy[0][self._to_brick_index(
+                ipos, OCCUPANCY_BRICK_SIZES[0])] == 0:
+            skipped = 1
+            size = OCCUPANCY_BRICK_SIZES[0]
+            for l in ti.static(range(1, len(OCCUPANCY_BRICK_SIZES))):
+                if size == OCCUPANCY_BRICK_SIZES[l - 1] and self.occupancy[l][
+                        self._to_brick_index(
+                            ipos, OCCUPANCY_BRICK_SIZES[l])] == 0:
+                    size = OCCUPANCY_BRICK_SIZES[l]
+            half = self.voxel_grid_res // 2
+            lo = (ipos + half) // size * size - half
+            exit_plane = lo + (rsign + 1) // 2 * size
+            t_exit = (exit_plane - o) * rinv
+            k = 0
+            if t_exit[1] < t_exit[k]:
+                k = 1
+            if t_exit[2] < t_exit[k]:
+                k = 2
+            p = ti.floor(o + d * t_exit[k]).cast(ti.i32)
+            mm = ti.Vector([0, 0, 0])
+            mm[k] = 1
+            for i in ti.static(range(3)):
+                p[i] = ti.math.clamp(p[i], lo[i], lo[i] + size - 1)
+            ipos = p * (1 - mm) + mm * (exit_plane - (1 - rsign) // 2)
+            dis = (ipos - o + 0.5 + rsign * 0.5) * rinv
+            normal = -mm * rsign
+        return skipped, ipos, dis, normal
+
     @ti.func
     def inside_particle_grid(self, ipos):
         pos = ipos * self.voxel_dx
@@ -252,10 +598,19 @@ class Renderer:
         d = (d + fu * du + fv * dv).normalized()
         return d
 
-    @ti.kernel
-    def render(self):
-        ti.loop_config(block_dim=256)
-        for u, v in self.color_buffer:
+    @ti.func
+    def _sample_light_dir(self):
+        dir_noise = ti.Vector([
+            ti.random() - 0.5,
+            ti.random() - 0.5,
+            ti.random() - 0.5
+        ]) * self.light_direction_noise[None]
+        return (self.light_direction[None] + dir_noise).normalized()
+
+    @ti.func
+    def _render_pixel(self, u, v, max_depth: ti.template(),
+                      directional_light: ti.template()):
+        if self.pixel_active[u, v]:
             d = self.get_cast_dir(u, v)
             pos = self.camera_pos[None]
             t = 0.0
@@ -269,29 +624,25 @@ class Renderer:
             hit_background = 0
 
             # Tracing begin
-            for bounce in range(MAX_RAY_DEPTH):
+            for bounce in range(max_depth):
                 depth += 1
                 closest, normal, c, hit_light = self.next_hit(pos, d, t)
                 hit_pos = pos + closest * d
+                if ti.static(self.gbuffer):
+                    if bounce == 0:
+                        self._write_gbuffer(u, v, hit_pos, normal, c,
+                                            closest)
                 if not hit_light and normal.norm() != 0 and closest < 1e8:
                     d = out_dir(normal)
                     pos = hit_pos + 1e-4 * d
                     throughput *= c
 
-                    if ti.static(use_directional_light):
-                        dir_noise = ti.Vector([
-                            ti.random() - 0.5,
-                            ti.random() - 0.5,
-                            ti.random() - 0.5
-                        ]) * self.light_direction_noise[None]
-                        light_dir = (self.light_direction[None] +
-                                     dir_noise).normalized()
+                    if ti.static(directional_light):
+                        light_dir = self._sample_light_dir()
                         dot = light_dir.dot(normal)
                         if dot > 0:
-                            hit_light_ = 0
-                            dist, _, _, hit_light_ = self.next_hit(
-                                pos, light_dir, t)
-                            if dist > DIS_LIMIT:
+                            self._count('shadow_rays', 1)
+                            if not self.occluded(pos, light_dir):
                                 # far enough to hit directional light
                                 contrib += throughput * \
                                     self.light_color[None] * dot
@@ -302,6 +653,7 @@ class Renderer:
                 # Russian roulette
                 max_c = throughput.max()
                 if ti.random() > max_c:
+                    self._count('rr_terminations', 1)
                     throughput = [0, 0, 0]
                     break
                 else:
@@ -315,43 +667,930 @@ class Renderer:
                     # Direct hit to background
                     contrib = self.background_color[None]
             self.color_buffer[u, v] += contrib
+            self.luminance_sq_buffer[u, v] += contrib.dot(
+                ti.Vector(LUMINANCE))**2
+            self.pixel_spp[u, v] += 1
+            self._count('paths', 1)
+            self._count('bounces', depth)
+
+    @ti.kernel
+    def _render_megakernel(self, max_depth: ti.template(),
+                           directional_light: ti.template()):
+        ti.loop_config(block_dim=256)
+        for u, v in self.color_buffer:
+            self._render_pixel(u, v, max_depth, directional_light)
+
+    @ti.kernel
+    def _render_tile_megakernel(self, x0: ti.i32, y0: ti.i32, width: ti.i32,
+                                height: ti.i32, max_depth: ti.template(),
+                                directional_light: ti.template()):
+        ti.loop_config(block_dim=256)
+        for i, j in ti.ndrange(width, height):
+            self._render_pixel(x0 + i, y0 + j, max_depth, directional_light)
+
+    def _drain_counters(self):
+        if self.profile_counters:
+            self._counter_totals += self.counters.to_numpy()
+            self.counters.fill(0)
+
+    def read_counters(self):
+        """
+        Return the device counters accumulated since the last call as a
+        dict, and reset them. Needs `profile_counters=True`.
+        """
+        self._drain_counters()
+        values = self._counter_totals
+        self._counter_totals = np.zeros(len(COUNTERS), dtype=np.int64)
+        return {name: int(value) for name, value in zip(COUNTERS, values)}
+
+    def set_quality(self, preset):
+        """
+        Switch to one of QUALITY_PRESETS. `max_ray_depth` and
+        `directional_light` can also be set directly; other values are
+        compiled on first use.
+        """
+        if preset not in QUALITY_PRESETS:
+            raise ValueError(f'Unknown quality preset: {preset}')
+        self.quality = preset
+        self.max_ray_depth = QUALITY_PRESETS[preset]['max_ray_depth']
+
+    def render(self):
+        """
+        Add one sample to every active pixel. Voxel edits must have been
+        flushed with flush_voxel_edits(), which the Scene's render methods
+        do: checking here would sync the device on every call, and unflushed
+        edits render with a stale bbox and, with `surface_cache`, as black
+        surface records.
+        """
+        if self.path_tracer == 'wavefront':
+            self._render_wavefront(0, 0, *self.image_res)
+        else:
+            self._render_megakernel(self.max_ray_depth,
+                                    self.directional_light)
+        self._drain_counters()
+
+    def render_tile(self, x0, y0, width, height):
+        # Like render(), expects flushed voxel edits
+        if self.path_tracer == 'wavefront':
+            self._render_wavefront(x0, y0, width, height)
+        else:
+            self._render_tile_megakernel(x0, y0, width, height,
+                                         self.max_ray_depth,
+                                         self.directional_light)
+        self._drain_counters()
+
+    def _allocate_wavefront_queues(self):
+        # State of one path per pixel, addressed through compacted queues
+        # of path indices: ray_queue[k] holds the paths traced at even (k=0)
+        # or odd (k=1) bounces, the shadow queue the light samples to test.
+        n = self.image_res[0] * self.image_res[1]
+        self.path_pixel = ti.Vector.field(2, dtype=ti.i32)
+        self.path_origin = ti.Vector.field(3, dtype=ti.f32)
+        self.path_dir = ti.Vector.field(3, dtype=ti.f32)
+        self.path_throughput = ti.Vector.field(3, dtype=ti.f32)
+        self.path_contrib = ti.Vector.field(3, dtype=ti.f32)
+        self.path_distance = ti.field(dtype=ti.f32)
+        self.path_normal = ti.Vector.field(3, dtype=ti.f32)
+        self.path_color = ti.Vector.field(3, dtype=ti.f32)
+        self.path_hit_light = ti.field(dtype=ti.i32)
+        ti.root.dense(ti.i, n).place(self.path_pixel, self.path_origin,
+                                     self.path_dir, self.path_throughput,
+                                     self.path_contrib, self.path_distance,
+                                     self.path_normal, self.path_color,
+                                     self.path_hit_light)
+        self.ray_queue = ti.field(dtype=ti.i32, shape=(2, n))
+        self.ray_queue_size = ti.field(dtype=ti.i32, shape=2)
+        self.num_paths = ti.field(dtype=ti.i32, shape=())
+        self.shadow_path = ti.field(dtype=ti.i32)
+        self.shadow_origin = ti.Vector.field(3, dtype=ti.f32)
+        self.shadow_dir = ti.Vector.field(3, dtype=ti.f32)
+        self.shadow_contrib = ti.Vector.field(3, dtype=ti.f32)
+        ti.root.dense(ti.i, n).place(self.shadow_path, self.shadow_origin,
+                                     self.shadow_dir, self.shadow_contrib)
+        self.shadow_queue_size = ti.field(dtype=ti.i32, shape=())
+
+    @ti.kernel
+    def _generate_rays(self, x0: ti.i32, y0: ti.i32, width: ti.i32,
+                       height: ti.i32):
+        self.ray_queue_size[0] = 0
+        for i, j in ti.ndrange(width, height):
+            u, v = x0 + i, y0 + j
+            if self.pixel_active[u, v]:
+                path = ti.atomic_add(self.ray_queue_size[0], 1)
+                self.path_pixel[path] = ti.Vector([u, v])
+                self.path_origin[path] = self.camera_pos[None]
+                self.path_dir[path] = self.get_cast_dir(u, v)
+                self.path_throughput[path] = ti.Vector([1.0, 1.0, 1.0])
+                self.path_contrib[path] = ti.Vector([0.0, 0.0, 0.0])
+                self.ray_queue[0, path] = path
+                self._count('paths', 1)
+        self.num_paths[None] = self.ray_queue_size[0]
+
+    @ti.kernel
+    def _extend(self, queue: ti.i32):
+        # Closest hits of all queued rays
+        for k in range(self.ray_queue_size[queue]):
+            path = self.ray_queue[queue, k]
+            closest, normal, c, hit_light = self.next_hit(
+                self.path_origin[path], self.path_dir[path], 0.0)
+            self.path_distance[path] = closest
+            self.path_normal[path] = normal
+            self.path_color[path] = c
+            self.path_hit_light[path] = hit_light
+
+    @ti.kernel
+    def _shade(self, queue: ti.i32, bounce: ti.i32, max_depth: ti.i32,
+               directional_light: ti.template()):
+        # The body of _render_pixel()'s bounce loop: terminate paths that
+        # left the scene or hit a light, queue a shadow ray and the next
+        # bounce for the others
+        self.ray_queue_size[1 - queue] = 0
+        self.shadow_queue_size[None] = 0
+        for k in range(self.ray_queue_size[queue]):
+            path = self.ray_queue[queue, k]
+            closest = self.path_distance[path]
+            normal = self.path_normal[path]
+            c = self.path_color[path]
+            hit_light = self.path_hit_light[path]
+            hit_pos = self.path_origin[path] + closest * self.path_dir[path]
+            if ti.static(self.gbuffer):
+                if bounce == 0:
+                    u, v = self.path_pixel[path]
+                    self._write_gbuffer(u, v, hit_pos, normal, c, closest)
+            throughput = self.path_throughput[path]
+            self._count('bounces', 1)
+            if not hit_light and normal.norm() != 0 and closest < 1e8:
+                d = out_dir(normal)
+                pos = hit_pos + 1e-4 * d
+                throughput *= c
+
+                if ti.static(directional_light):
+                    light_dir = self._sample_light_dir()
+                    dot = light_dir.dot(normal)
+                    if dot > 0:
+                        self._count('shadow_rays', 1)
+                        s = ti.atomic_add(self.shadow_queue_size[None], 1)
+                        self.shadow_path[s] = path
+                        self.shadow_origin[s] = pos
+                        self.shadow_dir[s] = light_dir
+                        self.shadow_contrib[s] = (throughput *
+                                                  self.light_color[None] * dot)
+
+                # Russian roulette
+                max_c = throughput.max()
+                survived = ti.random() <= max_c
+                if not survived:
+                    self._count('rr_terminations', 1)
+                if survived and bounce + 1 < max_depth:
+                    self.path_throughput[path] = throughput / max_c
+                    self.path_origin[path] = pos
+                    self.path_dir[path] = d
+                    next_k = ti.atomic_add(self.ray_queue_size[1 - queue], 1)
+                    self.ray_queue[1 - queue, next_k] = path
+            elif hit_light:
+                self.path_contrib[path] += throughput * c
+            elif bounce == 0:
+                # Direct hit to background
+                self.path_contrib[path] = self.background_color[None]
+
+    @ti.kernel
+    def _trace_shadows(self):
+        for k in range(self.shadow_queue_size[None]):
+            if not self.occluded(self.shadow_origin[k], self.shadow_dir[k]):
+                # far enough to hit directional light
+                self.path_contrib[self.shadow_path[k]] += \
+                    self.shadow_contrib[k]
+
+    @ti.kernel
+    def _accumulate_paths(self):
+        for path in range(self.num_paths[None]):
+            u, v = self.path_pixel[path]
+            contrib = self.path_contrib[path]
+            self.color_buffer[u, v] += contrib
+            self.luminance_sq_buffer[u, v] += contrib.dot(
+                ti.Vector(LUMINANCE))**2
+            self.pixel_spp[u, v] += 1
+
+    def _render_wavefront(self, x0, y0, width, height):
+        # Each stage is a kernel over a compacted queue, so threads of a
+        # kernel run the same code and terminated paths cost nothing
+        self._generate_rays(x0, y0, width, height)
+        for bounce in range(self.max_ray_depth):
+            self._extend(bounce % 2)
+            self._shade(bounce % 2, bounce, self.max_ray_depth,
+                        self.directional_light)
+            self._trace_shadows()
+        self._accumulate_paths()
+
+    @ti.kernel
+    def _primary_hits(self, origins: ti.types.ndarray(dtype=ti.math.vec3,
+                                                      ndim=2),
+                      normals: ti.types.ndarray(dtype=ti.math.vec3, ndim=2)):
+        for u, v in self.color_buffer:
+            d = self.get_cast_dir(u, v)
+            closest, normal, _, hit_light = self.next_hit(
+                self.camera_pos[None], d, 0.0)
+            if hit_light or normal.norm() == 0 or closest >= 1e8:
+                normal = ti.Vector([0.0, 0.0, 0.0])
+            origins[u, v] = self.camera_pos[None] + closest * d + 1e-4 * normal
+            normals[u, v] = normal
+
+    def shadow_ray_buffers(self):
+        """
+        Return device arrays for trace_shadow_rays(): the surface point seen
+        through each pixel, its normal (zero where the camera sees the
+        background or a light), and a mask for the results.
+        """
+        origins = ti.Vector.ndarray(3, ti.f32, shape=self.image_res)
+        normals = ti.Vector.ndarray(3, ti.f32, shape=self.image_res)
+        self._primary_hits(origins, normals)
+        return origins, normals, ti.ndarray(ti.i8, shape=self.image_res)
+
+    @ti.kernel
+    def trace_shadow_rays(self, origins: ti.types.ndarray(dtype=ti.math.vec3,
+                                                          ndim=2),
+                          normals: ti.types.ndarray(dtype=ti.math.vec3,
+                                                    ndim=2),
+                          shadowed: ti.types.ndarray(dtype=ti.i8,
+                                                     ndim=2)) -> ti.i32:
+        """
+        Trace the directional-light shadow ray that render() casts at the
+        first bounce, for each point from shadow_ray_buffers(), and mark the
+        occluded ones in `shadowed`. This times shadow rays in isolation.
+        Returns the number of rays traced.
+        """
+        num_rays = 0
+        for u, v in shadowed:
+            shadowed[u, v] = ti.i8(0)
+            normal = normals[u, v]
+            if normal.norm() != 0:
+                light_dir = self._sample_light_dir()
+                if light_dir.dot(normal) > 0:
+                    shadowed[u, v] = ti.cast(
+                        self.occluded(origins[u, v], light_dir), ti.i8)
+                    num_rays += 1
+        return num_rays
+
+    @ti.func
+    def _write_gbuffer(self, u, v, hit_pos, normal, c, closest):
+        # Position and normal are those of the first sample after a reset.
+        # Albedo is averaged over all samples, like the color it divides.
+        n = self.pixel_spp[u, v]
+        albedo = ti.Vector([1.0, 1.0, 1.0])
+        if normal.norm() != 0 and closest < 1e8:
+            albedo = c
+            if n == 0:
+                self.gbuffer_position[u, v] = hit_pos
+                self.gbuffer_normal[u, v] = normal
+        elif n == 0:
+            self.gbuffer_position[u, v] = ti.Vector([0.0, 0.0, 0.0])
+            self.gbuffer_normal[u, v] = ti.Vector([0.0, 0.0, 0.0])
+        self.gbuffer_albedo[u, v] += (albedo -
+                                      self.gbuffer_albedo[u, v]) / (n + 1)
+
+    @ti.func
+    def _to_pixel(self, w, camera_pos, look_at, fov):
+        # Pixel that sees world direction `w` from a camera; the inverse of
+        # get_cast_dir() without the jitter
+        d = (look_at - camera_pos).normalized()
+        du = d.cross(self.up[None]).normalized()
+        dv = du.cross(d).normalized()
+        z = w.dot(d)
+        fu = w.dot(du) / z
+        fv = w.dot(dv) / z
+        scale = self.image_res[1] / (2 * fov)
+        pixel = ti.floor(
+            ti.Vector([(fu + fov * self.aspect_ratio + 1e-5) * scale,
+                       (fv + fov + 1e-5) * scale])).cast(ti.i32)
+        inside = (z > 0 and 0 <= pixel[0] < self.image_res[0]
+                  and 0 <= pixel[1] < self.image_res[1])
+        return pixel, inside
+
+    @ti.kernel
+    def _store_view(self):
+        self.view_camera_pos[None] = self.camera_pos[None]
+        self.view_look_at[None] = self.look_at[None]
+        self.view_fov[None] = self.fov[None]
+
+    @ti.kernel
+    def _store_history(self):
+        for u, v in self.color_buffer:
+            self.history_color[u, v] = self.color_buffer[u, v]
+            self.history_luminance_sq[u, v] = self.luminance_sq_buffer[u, v]
+            self.history_spp[u, v] = self.pixel_spp[u, v]
+            self.history_position[u, v] = self.gbuffer_position[u, v]
+            self.history_normal[u, v] = self.gbuffer_normal[u, v]
+
+    @ti.kernel
+    def _reproject(self):
+        for u, v in self.color_buffer:
+            d = self.get_cast_dir(u, v)
+            pos = self.camera_pos[None]
+            closest, normal, c, _ = self.next_hit(pos, d, 0.0)
+            hit_pos = pos + closest * d
+            self.pixel_spp[u, v] = 0
+            self._write_gbuffer(u, v, hit_pos, normal, c, closest)
+            hit = self.gbuffer_normal[u, v].norm() != 0
+            w = d
+            if hit:
+                w = hit_pos - self.view_camera_pos[None]
+            p, valid = self._to_pixel(w, self.view_camera_pos[None],
+                                      self.view_look_at[None],
+                                      self.view_fov[None])
+            n = 0
+            if valid:
+                n = self.history_spp[p]
+                old_normal = self.history_normal[p]
+                if hit:
+                    if (old_normal.dot(normal) < REPROJECTION_NORMAL_COS or
+                            abs((self.history_position[p] - hit_pos).dot(
+                                normal)) > REPROJECTION_PLANE_DISTANCE *
+                            self.voxel_dx):
+                        n = 0
+                elif old_normal.norm() != 0:
+                    n = 0
+            if n > 0:
+                kept = min(n, REPROJECTION_MAX_SPP)
+                scale = kept / n
+                self.color_buffer[u, v] = self.history_color[p] * scale
+                self.luminance_sq_buffer[u, v] = (
+                    self.history_luminance_sq[p] * scale)
+                self.pixel_spp[u, v] = kept
+            else:
+                self.color_buffer[u, v] = ti.Vector([0.0, 0.0, 0.0])
+                self.luminance_sq_buffer[u, v] = 0.0
+                self.pixel_spp[u, v] = 0
+            self.pixel_active[u, v] = ti.i8(1)
+
+    def reproject(self):
+        """
+        Keep the accumulated samples after a camera move instead of
+        discarding them: each pixel of the new view looks up the pixel of
+        the previous view that saw the same surface, and starts from its
+        samples (up to REPROJECTION_MAX_SPP of them) unless the normal or
+        depth disagrees. Needs `reprojection=True`; call it after moving
+        the camera, in place of reset_framebuffer().
+        """
+        if not self._view_stored:
+            self.reset_framebuffer()
+            return
+        self._store_history()
+        self._reproject()
+        self._store_view()
+        self.current_spp = 0
 
     @ti.kernel
-    def _render_to_image(self, samples: ti.i32):
+    def _update_convergence(self, noise_threshold: ti.f32,
+                            min_spp: ti.i32) -> ti.i32:
+        num_active = 0
+        for u, v in self.color_buffer:
+            n = self.pixel_spp[u, v]
+            if self.pixel_active[u, v] and n >= min_spp:
+                mean = self.color_buffer[u, v].dot(ti.Vector(LUMINANCE)) / n
+                variance = max(self.luminance_sq_buffer[u, v] / n - mean**2,
+                               0.0)
+                # Standard error of the mean, propagated through the
+                # sqrt(x * k) tonemapping of _tonemap, k = vignette *
+                # exposure: d sqrt(k x) = sqrt(k) dx / (2 sqrt(x))
+                k = self._vignette(u, v) * self.exposure
+                error = ti.sqrt(k * variance /
+                                (n - 1)) / (2 * ti.sqrt(mean) + 1e-6)
+                if error < noise_threshold:
+                    self.pixel_active[u, v] = ti.i8(0)
+            if self.pixel_active[u, v]:
+                num_active += 1
+        return num_active
+
+    def update_convergence(self, noise_threshold, min_spp=16):
+        """
+        Stop sampling pixels whose estimated noise (standard error of the
+        displayed value, in [0, 1] units) is below `noise_threshold` after
+        at least `min_spp` samples. Returns the number of pixels that are
+        still sampled by render().
+        """
+        return self._update_convergence(noise_threshold, min_spp)
+
+    @ti.func
+    def _vignette(self, i, j):
+        # Darkening of pixel (i, j) towards the image borders
+        u = 1.0 * i / self.image_res[0]
+        v = 1.0 * j / self.image_res[1]
+        return 1.0 - self.vignette_strength * max((ti.sqrt(
+            (u - self.vignette_center[0])**2 +
+            (v - self.vignette_center[1])**2) - self.vignette_radius), 0)
+
+    @ti.func
+    def _tonemap(self, i, j, color, n):
+        # Vignette, exposure and gamma of the sum of `n` samples
+        darken = self._vignette(i, j)
+        for c in ti.static(range(3)):
+            self._rendered_image[i, j][c] = ti.sqrt(color[c] * darken *
+                                                    self.exposure / n)
+
+    @ti.kernel
+    def _render_to_image(self):
         for i, j in self.color_buffer:
-            u = 1.0 * i / self.image_res[0]
-            v = 1.0 * j / self.image_res[1]
+            self._tonemap(i, j, self.color_buffer[i, j],
+                          max(self.pixel_spp[i, j], 1))
 
-            darken = 1.0 - self.vignette_strength * max((ti.sqrt(
-                (u - self.vignette_center[0])**2 +
-                (v - self.vignette_center[1])**2) - self.vignette_radius), 0)
+    @ti.func
+    def _illumination(self, i, j):
+        # Mean color with the first hit's albedo divided out, so that the
+        # filter does not blur voxel colors and edges
+        albedo = ti.max(self.gbuffer_albedo[i, j], 1e-3)
+        return self.color_buffer[i, j] / max(self.pixel_spp[i, j], 1) / albedo
 
-            for c in ti.static(range(3)):
-                self._rendered_image[i, j][c] = ti.sqrt(
-                    self.color_buffer[i, j][c] * darken * self.exposure /
-                    samples)
+    @ti.kernel
+    def _prepare_denoise(self):
+        for i, j in self.color_buffer:
+            n = self.pixel_spp[i, j]
+            variance = 0.0
+            if n >= DENOISE_MIN_SPP:
+                # Variance of the mean, from the pixel's own samples
+                mean = self.color_buffer[i, j].dot(ti.Vector(LUMINANCE)) / n
+                albedo = max(
+                    self.gbuffer_albedo[i, j].dot(ti.Vector(LUMINANCE)), 1e-3)
+                variance = max(self.luminance_sq_buffer[i, j] / n - mean**2,
+                               0.0) / n / albedo**2
+            else:
+                # Too few samples: use the spread of the 3x3 neighborhood
+                # with the same normal
+                normal = self.gbuffer_normal[i, j]
+                total = 0.0
+                total_sq = 0.0
+                count = 0
+                for a, b in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+                    q = ti.Vector([i + a, j + b])
+                    if (0 <= q[0] < self.image_res[0]
+                            and 0 <= q[1] < self.image_res[1]
+                            and all(self.gbuffer_normal[q] == normal)):
+                        l = self._illumination(q[0], q[1]).dot(
+                            ti.Vector(LUMINANCE))
+                        total += l
+                        total_sq += l * l
+                        count += 1
+                variance = max(total_sq / count - (total / count)**2, 0.0)
+            self._denoise_color[0][i, j] = self._illumination(i, j)
+            self._denoise_variance[0][i, j] = variance
+
+    @ti.kernel
+    def _atrous(self, src: ti.template(), dst: ti.template(),
+                src_variance: ti.template(), dst_variance: ti.template(),
+                step: ti.i32):
+        # One pass of the edge-avoiding a-trous wavelet filter (Dammertz et
+        # al. 2010) with SVGF's luminance weights (Schied et al. 2017)
+        h = ti.static((1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16))
+        g = ti.static((1 / 4, 1 / 2, 1 / 4))
+        for i, j in src:
+            p = ti.Vector([i, j])
+            # Prefiltering the variance makes the luminance weights robust
+            # to pixels whose few samples happen to agree
+            variance = 0.0
+            for a, b in ti.static(ti.ndrange(3, 3)):
+                q = ti.math.clamp(p + ti.Vector([a - 1, b - 1]), 0,
+                                  ti.Vector(self.image_res) - 1)
+                variance += g[a] * g[b] * src_variance[q]
+            luminance = src[p].dot(ti.Vector(LUMINANCE))
+            inv_sigma_luminance = 1 / (DENOISE_SIGMA_LUMINANCE *
+                                       ti.sqrt(variance) + 1e-6)
+            inv_sigma_plane = 1 / (DENOISE_SIGMA_PLANE * self.voxel_dx)
+            normal = self.gbuffer_normal[p]
+            position = self.gbuffer_position[p]
+            total = ti.Vector([0.0, 0.0, 0.0])
+            total_variance = 0.0
+            total_weight = 0.0
+            for a, b in ti.static(ti.ndrange(5, 5)):
+                q = p + ti.Vector([a - 2, b - 2]) * step
+                if (0 <= q[0] < self.image_res[0]
+                        and 0 <= q[1] < self.image_res[1]):
+                    n = self.gbuffer_normal[q]
+                    # Background only blends with background
+                    w = ti.cast(normal.norm_sqr() == n.norm_sqr(), ti.f32)
+                    distance = abs(src[q].dot(ti.Vector(LUMINANCE)) -
+                                   luminance) * inv_sigma_luminance
+                    if normal.norm_sqr() != 0:
+                        # Repeated squaring, as pow() is slow
+                        w = max(normal.dot(n), 0.0)
+                        for _ in ti.static(
+                                range(DENOISE_NORMAL_POWER.bit_length() - 1)):
+                            w *= w
+                        distance += abs((self.gbuffer_position[q] -
+                                         position).dot(normal)) * \
+                            inv_sigma_plane
+                    w *= h[a] * h[b] * ti.exp(-distance)
+                    total += w * src[q]
+                    total_variance += w * w * src_variance[q]
+                    total_weight += w
+            dst[p] = total / total_weight
+            dst_variance[p] = total_variance / total_weight**2
+
+    @ti.kernel
+    def _denoised_to_image(self, src: ti.template()):
+        for i, j in self.color_buffer:
+            self._tonemap(i, j, src[i, j] * self.gbuffer_albedo[i, j], 1)
+
+    def denoise_image(self):
+        """
+        Render the displayed image through the edge-aware denoiser instead
+        of from the raw sample mean. The first hit's albedo is divided out,
+        and the remaining illumination is smoothed over DENOISE_ITERATIONS
+        a-trous passes. The passes stop at changes of normal or depth and
+        at luminance differences that are large compared to the noise. Needs
+        `denoise=True`.
+        """
+        self._prepare_denoise()
+        for k in range(DENOISE_ITERATIONS):
+            self._atrous(self._denoise_color[k % 2],
+                         self._denoise_color[1 - k % 2],
+                         self._denoise_variance[k % 2],
+                         self._denoise_variance[1 - k % 2], 2**k)
+        self._denoised_to_image(self._denoise_color[DENOISE_ITERATIONS % 2])
 
     @ti.kernel
     def recompute_bbox(self):
         for d in ti.static(range(3)):
             self.bbox[0][d] = 1e9
             self.bbox[1][d] = -1e9
-        for I in ti.grouped(self.voxel_material):
-            if self.voxel_material[I] != 0:
+        for I in ti.grouped(self._voxels):
+            if self._voxel_material(I) != 0:
                 for d in ti.static(range(3)):
                     ti.atomic_min(self.bbox[0][d], (I[d] - 1) * self.voxel_dx)
                     ti.atomic_max(self.bbox[1][d], (I[d] + 2) * self.voxel_dx)
 
+    @ti.kernel
+    def _mark_occupancy(self):
+        for I in ti.grouped(self._voxels):
+            if self._voxel_material(I) != 0:
+                for l in ti.static(range(len(OCCUPANCY_BRICK_SIZES))):
+                    self.occupancy[l][self._to_brick_index(
+                        I, OCCUPANCY_BRICK_SIZES[l])] = ti.i8(1)
+
+    def recompute_occupancy(self):
+        for occupancy in self.occupancy:
+            occupancy.fill(0)
+        self._mark_occupancy()
+
+    @ti.func
+    def _expand_bbox(self, I):
+        # Check before the atomics: most voxels do not grow the bbox, and
+        # this avoids contention on the six bbox components.
+        for d in ti.static(range(3)):
+            lo = (I[d] - 1) * self.voxel_dx
+            hi = (I[d] + 2) * self.voxel_dx
+            if lo < self.bbox[0][d]:
+                ti.atomic_min(self.bbox[0][d], lo)
+            if hi > self.bbox[1][d]:
+                ti.atomic_max(self.bbox[1][d], hi)
+
+    @ti.func
+    def _track_voxel_edit(self, I, was_occupied, occupied):
+        # Every flag is read before it is written: almost all edits hit
+        # bricks that are already flagged, and skipping those stores keeps
+        # threads from contending on the same cells
+        if not self.voxels_dirty[None]:
+            self.voxels_dirty[None] = 1
+        brick = self._to_brick_index(I, OCCUPANCY_BRICK_SIZES[0])
+        if not self.dirty_bricks[brick]:
+            self.dirty_bricks[brick] = ti.i8(1)
+        if occupied:
+            self._expand_bbox(I)
+            # Coarse bricks are occupied whenever a fine brick inside is
+            if not self.occupancy[0][brick]:
+                for l in ti.static(range(len(OCCUPANCY_BRICK_SIZES))):
+                    self.occupancy[l][self._to_brick_index(
+                        I, OCCUPANCY_BRICK_SIZES[l])] = ti.i8(1)
+        elif was_occupied:
+            if not self.bbox_stale[None]:
+                self.bbox_stale[None] = 1
+
+    @ti.kernel
+    def _rebuild_dirty_occupancy(self):
+        size = ti.static(OCCUPANCY_BRICK_SIZES[0])
+        for B in ti.grouped(self.dirty_bricks):
+            if self.dirty_bricks[B]:
+                occupied = 0
+                for J in ti.grouped(ti.ndrange(size, size, size)):
+                    if self._voxel_material(B * size + J) != 0:
+                        occupied = 1
+                self.occupancy[0][B] = ti.cast(occupied, ti.i8)
+        for l in ti.static(range(1, len(OCCUPANCY_BRICK_SIZES))):
+            ratio = ti.static(OCCUPANCY_BRICK_SIZES[l] //
+                              OCCUPANCY_BRICK_SIZES[0])
+            for B in ti.grouped(self.occupancy[l]):
+                # Coarse bricks only align with B * ratio when the grid's
+                # half-width is a multiple of their size
+                first = self._to_brick_index(
+                    self._brick_origin(B, OCCUPANCY_BRICK_SIZES[l]),
+                    OCCUPANCY_BRICK_SIZES[0])
+                occupied = 0
+                for J in ti.grouped(ti.ndrange(ratio, ratio, ratio)):
+                    if self.occupancy[0][first + J]:
+                        occupied = 1
+                self.occupancy[l][B] = ti.cast(occupied, ti.i8)
+
+    @ti.kernel
+    def _recompute_bbox_from_occupancy(self):
+        # Same result as recompute_bbox(), but only scans occupied bricks
+        for d in ti.static(range(3)):
+            self.bbox[0][d] = 1e9
+            self.bbox[1][d] = -1e9
+        size = ti.static(OCCUPANCY_BRICK_SIZES[0])
+        for B in ti.grouped(self.occupancy[0]):
+            if self.occupancy[0][B]:
+                for J in ti.grouped(ti.ndrange(size, size, size)):
+                    I = B * size + J
+                    if self._voxel_material(I) != 0:
+                        self._expand_bbox(I)
+
+    @ti.kernel
+    def _bake_surfaces(self):
+        # Pack the color and material of every voxel in the bricks written
+        # since the last flush into its surface record
+        size = ti.static(OCCUPANCY_BRICK_SIZES[0])
+        for B in ti.grouped(self.dirty_bricks):
+            if self.dirty_bricks[B]:
+                for J in ti.grouped(ti.ndrange(size, size, size)):
+                    I = B * size + J
+                    record = self._pack_voxel(self.voxel_material[I],
+                                              self.voxel_color[I])
+                    # Comparing first keeps sparse blocks of cleared voxels
+                    # from being activated by writing zeros
+                    if self.voxel_surface[I] != record:
+                        self.voxel_surface[I] = record
+
+    def flush_voxel_edits(self):
+        """
+        Bring the bbox, occupancy pyramid and surface records up to date
+        after set_voxel() calls. Returns whether any voxel was written since
+        the last flush. Only clearing voxels and baking surface records
+        require work here, proportional to the written bricks rather than
+        the whole grid.
+        """
+        if not self.voxels_dirty[None]:
+            return False
+        if self._baked_surfaces:
+            self._bake_surfaces()
+        if self.bbox_stale[None]:
+            self._rebuild_dirty_occupancy()
+            self._recompute_bbox_from_occupancy()
+            self.bbox_stale[None] = 0
+        self.dirty_bricks.fill(0)
+        self.voxels_dirty[None] = 0
+        return True
+
+    @ti.kernel
+    def _count_active_voxel_blocks(self) -> ti.i32:
+        n = 0
+        for I in ti.grouped(self._voxel_blocks):
+            n += 1
+        return n
+
+    def memory_usage(self):
+        """
+        Return the number of bytes used by each group of fields.
+        """
+        voxel_bytes = 4  # u8 x 3 color + i8 material, or one packed u32
+        if self._baked_surfaces:
+            voxel_bytes += 4  # baked surface record
+        # color + image, luminance moment, sample count, active mask
+        pixel_bytes = 4 * 3 * 2 + 4 + 4 + 1
+        if self.gbuffer:
+            pixel_bytes += 4 * 3 * 3  # position, normal, albedo
+        if self.reprojection:
+            # History: color, position, normal, luminance moment, sample count
+            pixel_bytes += 4 * 3 * 3 + 4 + 4
+        if self.denoise:
+            pixel_bytes += 2 * (4 * 3 + 4)  # ping-pong color and variance
+        if self.path_tracer == 'wavefront':
+            # Path state: pixel, 6 vec3, distance, hit_light; two ray queue
+            # entries; shadow ray: path, 3 vec3
+            pixel_bytes += (4 * 2 + 4 * 3 * 6 + 4 + 4) + 4 * 2 + (4 + 4 * 3 * 3)
+        if self.voxel_layout == 'dense':
+            voxels = self.voxel_grid_res**3 * voxel_bytes
+        else:
+            block_voxels = SPARSE_BLOCK_SIZE**3
+            # Each active block holds its voxels plus a one-bit mask per voxel
+            block_bytes = block_voxels * voxel_bytes + block_voxels // 8
+            pointers = (self.voxel_grid_res // SPARSE_BLOCK_SIZE)**3 * 8
+            voxels = (pointers +
+                      self._count_active_voxel_blocks() * block_bytes)
+        return {
+            'voxels': voxels,
+            'occupancy': sum((self.voxel_grid_res // size)**3
+                             for size in OCCUPANCY_BRICK_SIZES),
+            'framebuffer': self.image_res[0] * self.image_res[1] * pixel_bytes,
+        }
+
+    @ti.kernel
+    def _clear_dense_voxels(self):
+        # field.fill() passes an i32, which Taichi warns about for u8 colors
+        for I in ti.grouped(self._voxels):
+            if ti.static(self.voxel_storage == 'packed'):
+                self.voxel_data[I] = ti.u32(0)
+            else:
+                self.voxel_material[I] = ti.i8(0)
+                self.voxel_color[I] = ti.Vector([0, 0, 0], dt=ti.u8)
+            if ti.static(self._baked_surfaces):
+                self.voxel_surface[I] = ti.u32(0)
+
+    def clear_voxels(self):
+        if self.voxel_layout == 'sparse':
+            self._voxel_blocks.deactivate_all()
+        else:
+            self._clear_dense_voxels()
+        for occupancy in self.occupancy:
+            occupancy.fill(0)
+        self.bbox[0] = [1e9, 1e9, 1e9]
+        self.bbox[1] = [-1e9, -1e9, -1e9]
+        self.voxels_dirty[None] = 1
+
+    @ti.kernel
+    def _gather_bricks(self, bricks: ti.types.ndarray(),
+                       materials: ti.types.ndarray(),
+                       colors: ti.types.ndarray()):
+        size = ti.static(OCCUPANCY_BRICK_SIZES[0])
+        for n, i, j, k in ti.ndrange(bricks.shape[0], size, size, size):
+            I = ti.Vector([bricks[n, 0], bricks[n, 1], bricks[n, 2]
+                           ]) * size + ti.Vector([i, j, k])
+            materials[n, i, j, k] = self._voxel_material(I)
+            color = self._voxel_color(I)
+            for c in ti.static(range(3)):
+                colors[n, i, j, k, c] = color[c]
+
+    @ti.kernel
+    def _scatter_bricks(self, bricks: ti.types.ndarray(),
+                        materials: ti.types.ndarray(),
+                        colors: ti.types.ndarray()):
+        size = ti.static(OCCUPANCY_BRICK_SIZES[0])
+        for n, i, j, k in ti.ndrange(bricks.shape[0], size, size, size):
+            if materials[n, i, j, k] != 0:
+                I = ti.Vector([bricks[n, 0], bricks[n, 1], bricks[n, 2]
+                               ]) * size + ti.Vector([i, j, k])
+                self._write_voxel(
+                    I, materials[n, i, j, k],
+                    ti.Vector([
+                        colors[n, i, j, k, 0], colors[n, i, j, k, 1],
+                        colors[n, i, j, k, 2]
+                    ]))
+
+    def export_bricks(self):
+        """
+        Return the occupied 8^3 bricks as NumPy arrays: brick indices
+        (n x 3, relative to the grid center), materials (n x 8 x 8 x 8) and
+        colors (n x 8 x 8 x 8 x 3).
+        """
+        self.flush_voxel_edits()
+        occupied = self.occupancy[0].to_numpy()
+        bricks = np.argwhere(occupied).astype(np.int32) - occupied.shape[0] // 2
+        size = OCCUPANCY_BRICK_SIZES[0]
+        materials = np.zeros((len(bricks), size, size, size), dtype=np.int8)
+        colors = np.zeros((len(bricks), size, size, size, 3), dtype=np.uint8)
+        if len(bricks):
+            self._gather_bricks(bricks, materials, colors)
+        return bricks, materials, colors
+
+    def import_bricks(self, bricks, materials, colors):
+        """
+        Write bricks in the format of export_bricks() into the grid with a
+        single transfer. Empty voxels in the bricks are left untouched.
+        """
+        if materials.shape[1:] != (OCCUPANCY_BRICK_SIZES[0], ) * 3:
+            raise ValueError(f'Expected {OCCUPANCY_BRICK_SIZES[0]}^3 bricks, '
+                             f'got {materials.shape[1:]}')
+        if len(bricks):
+            self._scatter_bricks(np.ascontiguousarray(bricks, dtype=np.int32),
+                                 np.ascontiguousarray(materials),
+                                 np.ascontiguousarray(colors))
+
+    @ti.kernel
+    def _scatter_volume(self, materials: ti.types.ndarray(),
+                        colors: ti.types.ndarray(), offset: ti.types.vector(
+                            3, ti.i32)):
+        for i, j, k in ti.ndrange(*materials.shape):
+            if materials[i, j, k] != 0:
+                self._write_voxel(
+                    offset + ti.Vector([i, j, k]), materials[i, j, k],
+                    ti.Vector([
+                        colors[i, j, k, 0], colors[i, j, k, 1],
+                        colors[i, j, k, 2]
+                    ]))
+
+    @ti.kernel
+    def _scatter_points(self, coords: ti.types.ndarray(),
+                        materials: ti.types.ndarray(),
+                        colors: ti.types.ndarray(), offset: ti.types.vector(
+                            3, ti.i32)):
+        for n in range(coords.shape[0]):
+            self._write_voxel(
+                offset +
+                ti.Vector([coords[n, 0], coords[n, 1], coords[n, 2]]),
+                materials[n],
+                ti.Vector([colors[n, 0], colors[n, 1], colors[n, 2]]))
+
+    def set_voxels_from_numpy(self,
+                              materials,
+                              colors,
+                              offset=(0, 0, 0),
+                              coords=None):
+        """
+        Python-scope bulk version of set_voxel(). Without `coords`,
+        `materials` is an (X, Y, Z) volume written at `offset`; its empty
+        voxels are skipped. With `coords` (N x 3 voxel indices), `materials`
+        and `colors` hold one entry per coordinate. Colors have a trailing
+        axis of 3 and are integers in [0, 255] or floats in [0, 1].
+        """
+        materials = np.ascontiguousarray(materials, dtype=np.int8)
+        if not materials.size:
+            return
+        colors = np.asarray(colors)
+        if np.issubdtype(colors.dtype, np.floating):
+            colors = (np.clip(colors, 0.0, 1.0) * 255).astype(np.uint8)
+        elif colors.dtype != np.uint8:
+            if colors.size and (colors.min() < 0 or colors.max() > 255):
+                raise ValueError('Expected integer colors in [0, 255], got '
+                                 f'[{colors.min()}, {colors.max()}]')
+            colors = colors.astype(np.uint8)
+        colors = np.ascontiguousarray(colors)
+        if colors.shape != materials.shape + (3, ):
+            raise ValueError(f'Expected colors of shape '
+                             f'{materials.shape + (3, )}, got {colors.shape}')
+        if coords is None:
+            if materials.ndim != 3:
+                raise ValueError('Expected an (X, Y, Z) material volume')
+            self._scatter_volume(materials, colors, offset)
+        else:
+            coords = np.ascontiguousarray(coords, dtype=np.int32)
+            if coords.shape != (len(materials), 3):
+                raise ValueError(f'Expected coords of shape '
+                                 f'{(len(materials), 3)}, got {coords.shape}')
+            self._scatter_points(coords, materials, colors, offset)
+
+    def warm_up(self):
+        """
+        Compile the renderer's kernels, including the variants of every
+        quality preset, ahead of the first frame, which also stores them in
+        Taichi's offline cache, without rendering anything.
+        """
+        self.pixel_active.fill(0)
+        quality = (self.quality, self.max_ray_depth)
+        for preset in QUALITY_PRESETS:
+            self.set_quality(preset)
+            self.render()
+            self.render_tile(0, 0, 0, 0)
+        self.quality, self.max_ray_depth = quality
+        if self.reprojection:
+            self._store_history()
+            self._reproject()
+        self.reset_framebuffer()
+        self._render_to_image()
+        if self.denoise:
+            self.denoise_image()
+        self._update_convergence(1.0, 2**30)
+        self._rebuild_dirty_occupancy()
+        self._recompute_bbox_from_occupancy()
+        if self._baked_surfaces:
+            self._bake_surfaces()
+        self.recompute_bbox()
+        self._mark_occupancy()
+        if self.voxel_layout == 'sparse':
+            self._count_active_voxel_blocks()
+        ti.sync()
+
     def reset_framebuffer(self):
         self.current_spp = 0
         self.color_buffer.fill(0)
+        self.luminance_sq_buffer.fill(0)
+        self.pixel_spp.fill(0)
+        self.pixel_active.fill(1)
+        if self.reprojection:
+            self._store_view()
+            self._view_stored = True
+
+    def get_accumulation(self):
+        """
+        Return the raw per-pixel sums (color, squared luminance, sample
+        count) as NumPy arrays. Sums from independently seeded renders of
+        the same view can be added up and passed to set_accumulation().
+        """
+        return (self.color_buffer.to_numpy(),
+                self.luminance_sq_buffer.to_numpy(),
+                self.pixel_spp.to_numpy())
+
+    def set_accumulation(self, color, luminance_sq, spp):
+        self.color_buffer.from_numpy(color)
+        self.luminance_sq_buffer.from_numpy(luminance_sq)
+        self.pixel_spp.from_numpy(spp)
+        self.current_spp = int(spp.max())
 
     def accumulate(self):
         self.render()
         self.current_spp += 1
 
     def fetch_image(self):
-        self._render_to_image(self.current_spp)
+        if self.denoise:
+            self.denoise_image()
+        else:
+            self._render_to_image()
         return self._rendered_image
 
     @staticmethod
@@ -371,13 +1610,30 @@ class Renderer:
             r[i] = ti.cast(c[i], ti.f32) / 255.0
         return r
 
+    @ti.func
+    def _write_voxel(self, idx, mat, color_u8):
+        # Writes outside the grid used to land in arbitrary voxels
+        if self.inside_grid(idx):
+            was_occupied = self._voxel_material(idx) != 0
+            write = True
+            if ti.static(self.voxel_layout == 'sparse'):
+                # Storing an empty voxel in empty space would activate its
+                # pointer block, which is never freed
+                write = was_occupied or mat != 0
+            if write:
+                if ti.static(self.voxel_storage == 'packed'):
+                    self.voxel_data[idx] = self._pack_voxel(mat, color_u8)
+                else:
+                    self.voxel_material[idx] = ti.cast(mat, ti.i8)
+                    self.voxel_color[idx] = color_u8
+                self._track_voxel_edit(idx, was_occupied, mat != 0)
+
     @ti.func
     def set_voxel(self, idx, mat, color):
-        self.voxel_material[idx] = ti.cast(mat, ti.i8)
-        self.voxel_color[idx] = self.to_vec3u(color)
+        self._write_voxel(idx, mat, self.to_vec3u(color))
 
     @ti.func
     def get_voxel(self, ijk):
-        mat = self.voxel_material[ijk]
-        color = self.voxel_color[ijk]
+        mat = self._voxel_material(ijk)
+        color = self._voxel_color(ijk)
         return mat, self.to_vec3(color)
@@ -1,17 +1,27 @@
 import time
 import os
+import contextlib
+import functools
 from datetime import datetime
 import numpy as np
 import taichi as ti
 from renderer import Renderer
+from scheduler import TileScheduler
+from frame_controller import FrameController
+from voxel_io import read_bricks, write_bricks
+from image_writer import ImageWriter
+from profiler import Profiler
 from math_utils import np_normalize, np_rotate_matrix
 import __main__
 
 
+# Voxel size at the default 128^3 resolution; the grid spans [-1, 1)^3
 VOXEL_DX = 1 / 64
+DEFAULT_GRID_RES = 128
 SCREEN_RES = (1280, 720)
-TARGET_FPS = 30
 UP_DIR = (0, 1, 0)
+# Passes between per-pixel convergence checks in adaptive sampling
+CONVERGENCE_CHECK_INTERVAL = 8
 HELP_MSG = '''
 ====================================================
 Camera:
@@ -23,6 +33,39 @@ Camera:
 MAT_LAMBERTIAN = 1
 MAT_LIGHT = 2
 
+# Keyword arguments forced onto every Scene() created while a
+# `scene_overrides` block is active. This lets tools such as render.py run the
+# unmodified example scripts, e.g. headless on a CPU-only machine.
+_overrides = {}
+
+
+@contextlib.contextmanager
+def scene_overrides(**options):
+    saved = dict(_overrides)
+    _overrides.update(options)
+    try:
+        yield
+    finally:
+        _overrides.clear()
+        _overrides.update(saved)
+
+
+def _apply_overrides(init):
+    @functools.wraps(init)
+    def wrapper(self, *args, **kwargs):
+        kwargs.update(_overrides)
+        init(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _screenshot_path(ext):
+    timestamp = datetime.today().strftime('%Y-%m-%d-%H%M%S')
+    main_filename = os.path.split(__main__.__file__)[1]
+    return os.path.join(os.getcwd(), 'screenshot',
+                        f"{main_filename}-{timestamp}.{ext}")
+
+
 class Camera:
     def __init__(self, window, up):
         self._window = window
@@ -111,22 +154,130 @@ class Camera:
 
 
 class Scene:
-    def __init__(self, voxel_edges=0.06, exposure=3):
-        ti.init(arch=ti.vulkan)
-        print(HELP_MSG)
-        self.window = ti.ui.Window("Taichi Voxel Renderer",
-                                   SCREEN_RES,
-                                   vsync=True)
+    @_apply_overrides
+    def __init__(self,
+                 voxel_edges=0.06,
+                 exposure=3,
+                 headless=False,
+                 arch=None,
+                 image_res=SCREEN_RES,
+                 spp=64,
+                 output=None,
+                 noise_threshold=None,
+                 seed=0,
+                 hierarchical_dda=False,
+                 voxel_layout='dense',
+                 grid_res=DEFAULT_GRID_RES,
+                 warm_up=False,
+                 offline_cache_path=None,
+                 cpu_max_num_threads=None,
+                 print_startup_timings=False,
+                 capture_frames=None,
+                 image_writers=None,
+                 image_writer_processes=None,
+                 reprojection=False,
+                 denoise=False,
+                 path_tracer='megakernel',
+                 quality='final',
+                 moving_quality=None,
+                 profile=False,
+                 profile_output=None,
+                 frame_target=None,
+                 surface_cache=False,
+                 voxel_storage='aos',
+                 voxel_order='linear',
+                 on_finish=None):
+        """
+        With `headless=True` no window is opened and `finish()` renders `spp`
+        samples per pixel to the image file `output` instead of running the
+        interactive loop. `arch` defaults to ti.cpu in headless mode, ti.cuda
+        for the sparse voxel layout and ti.vulkan otherwise. If `on_finish`
+        is given, `finish()` calls `on_finish(scene)` once the scene is ready
+        instead of rendering it; benchmarks use this hook.
+
+        `scene.timings` records the seconds spent on startup ('init',
+        'compile', 'voxels', 'first_frame'); `print_startup_timings=True`
+        prints them after the first frame. The other keyword arguments are
+        rendering and performance options, listed in README.md.
+        """
+        t = time.perf_counter()
+        self.headless = headless
+        self.spp = spp
+        self.output = output
+        self.noise_threshold = noise_threshold
+        self.on_finish = on_finish
+        self.capture_frames = capture_frames
+        self.image_writers = image_writers
+        self.image_writer_processes = image_writer_processes
+        self.quality = quality
+        self.moving_quality = moving_quality
+        if arch is None:
+            if headless:
+                arch = ti.cpu
+            elif voxel_layout == 'sparse':
+                arch = ti.cuda
+            else:
+                arch = ti.vulkan
+        init_options = {}
+        if offline_cache_path is not None:
+            init_options.update(offline_cache=True,
+                                offline_cache_file_path=offline_cache_path)
+        if cpu_max_num_threads is not None:
+            init_options['cpu_max_num_threads'] = cpu_max_num_threads
+        ti.init(arch=arch, random_seed=seed, **init_options)
+        self.profile_output = profile_output
+        self.profiler = None
+        if profile or profile_output:
+            self.profiler = Profiler()
+            self.profiler.install()
+        if headless:
+            self.window = None
+        else:
+            print(HELP_MSG)
+            self.window = ti.ui.Window("Taichi Voxel Renderer",
+                                       image_res,
+                                       vsync=True)
         self.camera = Camera(self.window, up=UP_DIR)
-        self.renderer = Renderer(dx=VOXEL_DX,
-                                 image_res=SCREEN_RES,
+        self.renderer = Renderer(dx=VOXEL_DX * DEFAULT_GRID_RES / grid_res,
+                                 image_res=image_res,
                                  up=UP_DIR,
                                  voxel_edges=voxel_edges,
-                                 exposure=exposure)
+                                 exposure=exposure,
+                                 hierarchical_dda=hierarchical_dda,
+                                 voxel_layout=voxel_layout,
+                                 grid_res=grid_res,
+                                 reprojection=reprojection,
+                                 denoise=denoise,
+                                 path_tracer=path_tracer,
+                                 quality=quality,
+                                 profile_counters=self.profiler is not None,
+                                 surface_cache=surface_cache,
+                                 voxel_storage=voxel_storage,
+                                 voxel_order=voxel_order)
 
         self.renderer.set_camera_pos(*self.camera.position)
-        if not os.path.exists('screenshot'):
+        self.scheduler = TileScheduler(self.renderer)
+        self.frame_controller = FrameController(self.scheduler)
+        if frame_target is None:
+            frame_target = 'throughput' if headless else 'latency'
+        if frame_target == 'throughput':
+            self.frame_controller.set_throughput_target()
+        elif frame_target != 'latency':
+            raise ValueError(f'Unknown frame target {frame_target!r}')
+        if not headless and not os.path.exists('screenshot'):
             os.makedirs('screenshot')
+        self.print_startup_timings = print_startup_timings
+        ti.sync()
+        self.timings = {'init': time.perf_counter() - t}
+        # The window switches to moving_quality mid-interaction, where
+        # compiling its kernels would stall the camera
+        if warm_up or (moving_quality and not headless):
+            t = time.perf_counter()
+            self.renderer.warm_up()
+            self.timings['compile'] = time.perf_counter() - t
+        self._init_done = time.perf_counter()
+        # Set by finish(); frames rendered before it are not startup timings
+        self._finish_start = None
 
     @staticmethod
     @ti.func
@@ -146,6 +297,38 @@ class Scene:
         mat, color = self.renderer.get_voxel(self.round_idx(idx))
         return mat, color
 
+    def set_voxels_from_numpy(self,
+                              materials,
+                              colors,
+                              offset=(0, 0, 0),
+                              coords=None):
+        """
+        Write many voxels from Python scope in a single transfer, either as
+        an (X, Y, Z) `materials` volume with (X, Y, Z, 3) `colors` placed at
+        `offset`, or as `coords`/`materials`/`colors` lists of N voxels.
+        See Renderer.set_voxels_from_numpy().
+        """
+        self.renderer.set_voxels_from_numpy(materials, colors, offset, coords)
+
+    def save(self, path):
+        """
+        Save the voxels to a compact binary file that load() can read back
+        without running the code that generated them.
+        """
+        write_bricks(path, self.renderer.voxel_grid_res,
+                     *self.renderer.export_bricks())
+
+    def load(self, path):
+        """
+        Replace the voxels with the ones saved in `path`. The file is
+        memory-mapped and copied into the renderer in a single transfer.
+        Scenes saved at another grid resolution stay centered; voxels that
+        do not fit are dropped.
+        """
+        _, bricks, materials, colors = read_bricks(path)
+        self.renderer.clear_voxels()
+        self.renderer.import_bricks(bricks, materials, colors)
+
     def set_floor(self, height, color):
         self.renderer.floor_height[None] = height
         self.renderer.floor_color[None] = color
@@ -156,38 +339,198 @@ class Scene:
     def set_background_color(self, color):
         self.renderer.background_color[None] = color
 
+    def _record_first_frame(self):
+        if self._finish_start is None or 'first_frame' in self.timings:
+            return
+        ti.sync()
+        self.timings['first_frame'] = time.perf_counter() - self._finish_start
+        if self.print_startup_timings:
+            total = sum(self.timings.values())
+            parts = ', '.join(f'{name} {seconds:.2f}s'
+                              for name, seconds in self.timings.items())
+            print(f'Time to first frame: {total:.2f}s ({parts})')
+
+    def accumulate(self, spp, noise_threshold=None):
+        """
+        Render a fresh image with up to `spp` samples per pixel in frames
+        sized by the frame controller, stopping early once all pixels are
+        below `noise_threshold`, if given. Returns the samples per pixel
+        rendered; the result is read with fetch_image() or
+        get_accumulation() on `scene.renderer`.
+        """
+        self.renderer.flush_voxel_edits()
+        self.renderer.reset_framebuffer()
+        samples = 0
+        while samples < spp:
+            batch = spp - samples
+            if noise_threshold:
+                batch = min(
+                    batch, CONVERGENCE_CHECK_INTERVAL -
+                    samples % CONVERGENCE_CHECK_INTERVAL)
+            samples += self.frame_controller.render(max_spp=batch)
+            self._record_first_frame()
+            if self.profiler:
+                self.profiler.add_counters(self.renderer.read_counters())
+            if noise_threshold and samples % CONVERGENCE_CHECK_INTERVAL == 0:
+                if not self.renderer.update_convergence(noise_threshold):
+                    break
+        return self.renderer.current_spp
+
+    def render_animation(self,
+                         keyframes,
+                         output_pattern='frames/frame-{:04d}.png',
+                         spp=None,
+                         noise_threshold=None):
+        """
+        Render one image per camera keyframe (see animation.py) with `spp`
+        samples or until `noise_threshold` is reached, and save frame i to
+        `output_pattern.format(i)`. Frames are encoded and written in
+        background processes while the next one renders.
+        """
+        spp = spp or self.spp
+        noise_threshold = noise_threshold or self.noise_threshold
+        t = time.time()
+        processes = self.image_writer_processes
+        with ImageWriter(num_threads=self.image_writers,
+                         processes=processes is None or processes) as writer:
+            for i, keyframe in enumerate(keyframes):
+                self.renderer.set_camera_pos(*keyframe.position)
+                self.renderer.set_look_at(*keyframe.look_at)
+                if keyframe.fov is not None:
+                    self.renderer.set_fov(keyframe.fov)
+                self.accumulate(spp, noise_threshold)
+                writer.write(self.renderer.fetch_image().to_numpy(),
+                             output_pattern.format(i))
+        print(f"Rendered {len(keyframes)} frames in {time.time() - t:.2f}s, "
+              f"saved to {output_pattern}")
+
+    def render_offline(self, spp=None, output=None, noise_threshold=None):
+        spp = spp or self.spp
+        output = output or self.output or _screenshot_path('png')
+        noise_threshold = noise_threshold or self.noise_threshold
+        t = time.time()
+        spp = self.accumulate(spp, noise_threshold)
+        self.write_image(output)
+        print(f"Rendered {spp} spp in {time.time() - t:.2f}s, "
+              f"saved to {output}")
+        return output
+
+    def write_image(self, output):
+        img = self.renderer.fetch_image()
+        dirname = os.path.dirname(output)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        ti.tools.image.imwrite(img, output)
+
+    def _show_profile(self, frame_start):
+        self.profiler.add_counters(self.renderer.read_counters())
+        self.profiler.record('frame', 'scope', frame_start,
+                             time.perf_counter() - frame_start)
+        with self.window.get_gui().sub_window('Profile', 0.01, 0.01, 0.4,
+                                              0.3) as gui:
+            for line in self.profiler.hud_lines():
+                gui.text(line)
+
     def finish(self):
-        self.renderer.recompute_bbox()
+        self._finish()
+        if self.profiler:
+            self.profiler.uninstall()
+            if self.profile_output:
+                self.profiler.save_json(self.profile_output)
+                trace = os.path.splitext(self.profile_output)[0] + '.trace.json'
+                self.profiler.save_chrome_trace(trace)
+                print(f'Profile has been saved to {self.profile_output} '
+                      f'and {trace}')
+
+    def _finish(self):
+        self.renderer.flush_voxel_edits()
+        ti.sync()
+        self._finish_start = time.perf_counter()
+        self.timings['voxels'] = self._finish_start - self._init_done
+        if self.profiler:
+            self.profiler.record('voxels', 'scope', self._init_done,
+                                 self.timings['voxels'])
+        if self.on_finish is not None:
+            self.on_finish(self)
+            return
+        if self.headless:
+            self.render_offline()
+            return
         canvas = self.window.get_canvas()
-        spp = 1
+        processes = self.image_writer_processes
+        if processes is None:
+            # Encoding on a thread stalls the loop for the whole encode,
+            # which is only acceptable for occasional screenshots
+            processes = self.capture_frames is not None
+        writer = ImageWriter(num_threads=self.image_writers,
+                             processes=processes)
+        frame = 0
+        dropped_frames = 0
         while self.window.running:
+            frame_start = time.perf_counter()
+            if self.profiler:
+                self.profiler.begin_frame()
             should_reset_framebuffer = False
+            camera_moved = False
 
             if self.camera.update_camera():
                 self.renderer.set_camera_pos(*self.camera.position)
                 look_at = self.camera.look_at
                 self.renderer.set_look_at(*look_at)
+                camera_moved = True
+
+            if self.renderer.flush_voxel_edits():
                 should_reset_framebuffer = True
 
+            if self.moving_quality:
+                quality = self.moving_quality if camera_moved else self.quality
+                if quality != self.renderer.quality:
+                    self.renderer.set_quality(quality)
+                    # Samples of different presets must not be mixed,
+                    # unless the history is reprojected and fades anyway
+                    if not self.renderer.reprojection:
+                        should_reset_framebuffer = True
+
             if should_reset_framebuffer:
                 self.renderer.reset_framebuffer()
+                self.scheduler.reset()
+            elif camera_moved:
+                if self.renderer.reprojection:
+                    self.renderer.reproject()
+                else:
+                    self.renderer.reset_framebuffer()
+                self.scheduler.reset()
 
-            t = time.time()
-            for _ in range(spp):
-                self.renderer.accumulate()
-            img = self.renderer.fetch_image()
-            if self.window.is_pressed('p'):
-                timestamp = datetime.today().strftime('%Y-%m-%d-%H%M%S')
-                dirpath = os.getcwd()
-                main_filename = os.path.split(__main__.__file__)[1]
-                fname = os.path.join(dirpath, 'screenshot', f"{main_filename}-{timestamp}.jpg")
-                ti.tools.image.imwrite(img, fname)
-                print(f"Screenshot has been saved to {fname}")
-            canvas.set_image(img)
-            elapsed_time = time.time() - t
-            if elapsed_time * TARGET_FPS > 1:
-                spp = int(spp / (elapsed_time * TARGET_FPS) - 1)
-                spp = max(spp, 1)
-            else:
-                spp += 1
+            converged = False
+            if self.noise_threshold:
+                converged = not self.renderer.update_convergence(
+                    self.noise_threshold)
+            if not converged:
+                self.frame_controller.render()
+            with self.frame_controller.present():
+                img = self.renderer.fetch_image()
+                if self.window.is_pressed('p'):
+                    fname = _screenshot_path('jpg')
+                    writer.write(img.to_numpy(), fname)
+                    print(f"Screenshot will be saved to {fname}")
+                if self.capture_frames:
+                    if writer.full():
+                        # Blocking would drop the window to the encoders'
+                        # frame rate, so skip frames they cannot keep up with
+                        if not dropped_frames:
+                            print(f"Warning: the image writers cannot keep "
+                                  f"up, skipping frame {frame} and later "
+                                  f"ones while they are busy")
+                        dropped_frames += 1
+                    else:
+                        writer.write(img.to_numpy(),
+                                     self.capture_frames.format(frame))
+                canvas.set_image(img)
+            frame += 1
+            self._record_first_frame()
+            if self.profiler:
+                self._show_profile(frame_start)
             self.window.show()
+        writer.close()
+        if dropped_frames:
+            print(f"Skipped {dropped_frames} of {frame} captured frames")
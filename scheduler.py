@@ -0,0 +1,84 @@
+import collections
+import time
+
+import taichi as ti
+
+TILE_SIZE = 128
+# Weight of the newest measurement in the per-pixel cost estimate
+COST_SMOOTHING = 0.3
+# Upper bound on full passes over the frame in a single render() call
+MAX_PASSES_PER_RENDER = 64
+
+
+class TileScheduler:
+    def __init__(self, renderer, tile_size=TILE_SIZE):
+        """
+        Split the renderer's frame into tiles that are rendered from a
+        round-robin work queue, so that a frame can be spread over several
+        time-budgeted calls to `render()`.
+        """
+        self.renderer = renderer
+        width, height = renderer.image_res
+        self.tiles = [(x, y, min(tile_size, width - x),
+                       min(tile_size, height - y))
+                      for y in range(0, height, tile_size)
+                      for x in range(0, width, tile_size)]
+        self._queue = collections.deque(self.tiles)
+        # Seconds to render one sample of one pixel, None until measured
+        self.pixel_cost = None
+        # The first call includes JIT compilation and is not measured
+        self._compiled = False
+
+    def reset(self):
+        # Start over from the first tile, e.g. after a framebuffer reset
+        self._queue = collections.deque(self.tiles)
+
+    def split(self, num_parts):
+        """
+        Partition the tiles into `num_parts` interleaved lists, e.g. to hand
+        them to separate processes with `render_tiles`.
+        """
+        return [self.tiles[i::num_parts] for i in range(num_parts)]
+
+    def render_tiles(self, tiles, spp=1):
+        for _ in range(spp):
+            for tile in tiles:
+                self.renderer.render_tile(*tile)
+
+    def full_frame_time(self):
+        width, height = self.renderer.image_res
+        return (self.pixel_cost or 0.0) * width * height
+
+    def render(self, budget):
+        """
+        Render tiles from the work queue for about `budget` seconds and
+        return how many were rendered. At least one tile is always rendered.
+        """
+        if self.pixel_cost is None:
+            num_tiles = 1
+        else:
+            num_tiles = 0
+            planned = 0.0
+            while num_tiles < len(self.tiles) * MAX_PASSES_PER_RENDER:
+                x, y, w, h = self._queue[num_tiles % len(self._queue)]
+                planned += w * h * self.pixel_cost
+                if num_tiles and planned > budget:
+                    break
+                num_tiles += 1
+
+        pixels = 0
+        t = time.perf_counter()
+        for _ in range(num_tiles):
+            tile = self._queue.popleft()
+            self.renderer.render_tile(*tile)
+            self._queue.append(tile)
+            pixels += tile[2] * tile[3]
+        ti.sync()
+        cost = (time.perf_counter() - t) / pixels
+        if not self._compiled:
+            self._compiled = True
+        elif self.pixel_cost is None:
+            self.pixel_cost = cost
+        else:
+            self.pixel_cost += COST_SMOOTHING * (cost - self.pixel_cost)
+        return num_tiles
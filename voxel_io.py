@@ -0,0 +1,48 @@
+import numpy as np
+
+# File layout, all little-endian and uncompressed so that it can be
+# memory-mapped:
+#   header     MAGIC, then u32 grid_res, brick_size, num_bricks, reserved
+#   bricks     num_bricks x 3 i32, brick indices relative to the grid center
+#   materials  num_bricks x brick_size^3 i8
+#   colors     num_bricks x brick_size^3 x 3 u8
+# Only bricks containing at least one voxel are stored.
+MAGIC = b'TIVOXEL1'
+HEADER = np.dtype([('magic', 'S8'), ('grid_res', '<u4'),
+                   ('brick_size', '<u4'), ('num_bricks', '<u4'),
+                   ('reserved', '<u4')])
+
+
+def write_bricks(path, grid_res, bricks, materials, colors):
+    num_bricks, brick_size = materials.shape[:2]
+    header = np.array([(MAGIC, grid_res, brick_size, num_bricks, 0)],
+                      dtype=HEADER)
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(bricks, dtype='<i4').tobytes())
+        f.write(np.ascontiguousarray(materials, dtype=np.int8).tobytes())
+        f.write(np.ascontiguousarray(colors, dtype=np.uint8).tobytes())
+
+
+def _map(path, dtype, offset, shape):
+    if not shape[0]:
+        return np.zeros(shape, dtype)  # Empty regions cannot be mapped
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def read_bricks(path):
+    """
+    Memory-map a file written by write_bricks(). Returns the grid resolution
+    it was saved from and the brick, material and color arrays.
+    """
+    header = np.fromfile(path, dtype=HEADER, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError(f'{path} is not a voxel scene file')
+    n, size = int(header['num_bricks']), int(header['brick_size'])
+    offset = HEADER.itemsize
+    bricks = _map(path, '<i4', offset, (n, 3))
+    offset += bricks.nbytes
+    materials = _map(path, np.int8, offset, (n, size, size, size))
+    offset += materials.nbytes
+    colors = _map(path, np.uint8, offset, (n, size, size, size, 3))
+    return int(header['grid_res']), bricks, materials, colors